@@ -0,0 +1,947 @@
+# PyChat benchmarks
+# Run all with "python benchmark.py", or name the ones to run as arguments,
+# optionally with keyword options such as "load:clients=1000,rate=2".
+
+# Import
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import pychat
+
+try:
+    import old
+except ImportError: # No tkinter
+    old = None
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Utility
+MESSAGE = pychat.new(
+    name="John Doe", type="client", time=time.time(),
+    message="The quick brown fox jumps over the lazy dog.")
+
+def best(function, number, repeat=5) -> float:
+    """Return the best time in seconds for a single call to a function."""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+def percentile(samples, fraction) -> float:
+    """Return a percentile of sorted samples."""
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def report(title, header, rows):
+    """Print a table of benchmark results."""
+    print(title)
+    print("  " + "".join("%16s" % column for column in header))
+    for row in rows:
+        print("  " + "".join(
+            "%16s" % (cell if type(cell) is not float
+                      else "%.2f" % cell if cell < 1000 else "%.0f" % cell)
+            for cell in row))
+    print()
+
+class Sink:
+    """Stand-in for a connected handler that discards what it is sent."""
+
+    def write(self, data):
+        """Discard an encoded message."""
+
+def spin(server):
+    """The serve loop as it was before batching, polling an empty queue."""
+    while server.active:
+        while not server.messages.empty():
+            message = server.messages.get()
+            if message is None:
+                continue
+            formatted = pychat.string(message["template"], message)
+            server.send(pychat.new(message=formatted))
+
+def strftime(template, message) -> str:
+    """Message formatting as it was before templates were compiled, taking
+    a dict template and rendering the time for every message."""
+    if template.get("datefmt"):
+        message["datefmt"] = time.strftime(
+            template["datefmt"], time.localtime(message["time"]))
+    return template["format"] % message
+
+class Legacy:
+    """The stream as it was before receiving into a preallocated buffer,
+    appending each recv to a bytearray and decoding copies of it."""
+
+    def __init__(self):
+        """Initialize an empty stream buffer."""
+        self.buffer = bytearray()
+
+    def next(self):
+        """Return the next buffered message, or None."""
+        if len(self.buffer) < pychat.HEADER.size:
+            return None
+        size, = pychat.HEADER.unpack_from(self.buffer)
+        end = pychat.HEADER.size + size
+        if len(self.buffer) < end:
+            return None
+        message = pychat.decode(self.buffer[pychat.HEADER.size:end])
+        del self.buffer[:end]
+        return message
+
+    def read(self, socket):
+        """Return the next message from a socket."""
+        message = self.next()
+        while message is None:
+            data = socket.recv(pychat.SIZE)
+            if not data:
+                raise EOFError("connection closed")
+            self.buffer += data
+            message = self.next()
+        return message
+
+class Replay:
+    """Stand-in for a socket that returns recorded data in reads of at most
+    CHUNK bytes, so only the receive path itself is measured."""
+
+    def __init__(self, data, chunk):
+        """Initialize a socket replaying data."""
+        self.data = data
+        self.chunk = chunk
+        self.position = 0
+
+    def recv(self, size):
+        """Return the next read as a new bytes object, like socket.recv."""
+        size = min(size, self.chunk, len(self.data) - self.position)
+        data = bytes(self.data[self.position:self.position + size])
+        self.position += size
+        return data
+
+    def recv_into(self, buffer):
+        """Copy the next read into a buffer, like socket.recv_into."""
+        size = min(len(buffer), self.chunk, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+def noisy(server):
+    """The serve loop, logging an error for every message it handles, as
+    when a flood of malformed messages or disconnects hits an error path."""
+    while server.active:
+        for message in server.messages.batch(server.batch, server.linger):
+            if message is None:
+                continue
+            server.handle(message)
+            logging.log(logging.ERROR, "%r: %s in serve", server, "ValueError")
+
+def dispatch(loop, clients=10, number=50000, idle=1.0, **options):
+    """Run a serve loop over sink handlers and return the CPU seconds it burns
+    per idle second and its throughput in messages per second."""
+    server = pychat.Server(("127.0.0.1", 0), history=None, **options)
+    server.messages = queue.Queue() if loop is spin else server.messages
+    server.handlers = {Sink() for i in range(clients)}
+    server.active = True
+    thread = threading.Thread(target=loop, args=(server,))
+    thread.start()
+    start = time.process_time()
+    time.sleep(idle)
+    cpu = (time.process_time() - start) / idle
+    message = pychat.new(
+        time=time.time(), template=pychat.INFO, message="benchmark")
+    start = time.perf_counter()
+    for i in range(number):
+        server.messages.put(dict(message))
+    while server.messages.qsize():
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    server.active = False
+    server.messages.put(None)
+    thread.join()
+    return cpu, number / elapsed
+
+# Benchmark
+def codec(number=20000):
+    """Compare the framed binary codec against the pickle encoding it
+    replaced, including reassembly of a stream read in SIZE chunks."""
+    rows = []
+    pickled = pickle.dumps(MESSAGE)
+    framed = pychat.encode(MESSAGE)
+    body = framed[pychat.HEADER.size:]
+    rows.append((
+        "pickle", len(pickled),
+        best(lambda: pickle.dumps(MESSAGE), number) * 1e6,
+        best(lambda: pickle.loads(pickled), number) * 1e6, "-"))
+    data = framed * 1000
+    chunks = [
+        data[i:i + pychat.SIZE] for i in range(0, len(data), pychat.SIZE)]
+    def reassemble():
+        stream = pychat.Stream()
+        for chunk in chunks:
+            stream.feed(chunk)
+            while stream.next() is not None:
+                pass
+    rows.append((
+        "framed", len(framed),
+        best(lambda: pychat.encode(MESSAGE), number) * 1e6,
+        best(lambda: pychat.decode(body), number) * 1e6,
+        1000 / best(reassemble, 10)))
+    report(
+        "codec: per message cost of encode and decode",
+        ("codec", "bytes", "encode us", "decode us", "stream msg/s"), rows)
+
+def receive(number=20000, chunks=(None, 1024, 65536), sizes=(100, 16000)):
+    """Compare the legacy receive path with the preallocated one, for small
+    and large messages, read one frame per read as from chatty clients and
+    in larger reads. Reports time, peak memory, and the memory blocks left
+    allocated per message while the decoded messages are kept."""
+    rows = []
+    for size in sizes:
+        framed = pychat.encode(pychat.new(name="John Doe", message="x" * size))
+        count = max(100, number * 100 // size)
+        data = memoryview(framed * count)
+        for chunk in chunks:
+            for kind in (Legacy, pychat.Stream):
+                def run(messages=None):
+                    socket = Replay(data, chunk or len(framed))
+                    stream = kind()
+                    for i in range(count):
+                        message = stream.read(socket)
+                        if messages is not None:
+                            messages.append(message)
+                elapsed = best(run, 1)
+                tracemalloc.start()
+                run()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                messages = list()
+                blocks = sys.getallocatedblocks()
+                run(messages)
+                blocks = sys.getallocatedblocks() - blocks
+                del messages
+                rows.append((
+                    len(framed), chunk or "frame", kind.__name__,
+                    elapsed / count * 1e6, peak / 1024, blocks / count))
+    report(
+        "receive: per message cost of the receive path",
+        ("frame bytes", "read size", "stream", "us/msg", "peak KiB",
+         "blocks/msg"), rows)
+
+def serve():
+    """Compare idle CPU use and busy throughput of the serve loop against the
+    polling loop it replaced, at several batch and linger settings."""
+    rows = [("spin", "-", "-") + dispatch(spin)]
+    for batch, linger in ((1, 0.0), (64, 0.0), (256, 0.0), (256, 0.002)):
+        cpu, rate = dispatch(
+            pychat.Server.serve, batch=batch, linger=linger)
+        rows.append(("batch", batch, "%g" % linger, cpu, rate))
+    report(
+        "serve: idle CPU and throughput with 10 handlers",
+        ("loop", "batch", "linger", "idle cpu", "msg/s"), rows)
+
+class Slow(logging.FileHandler):
+    """File handler that blocks for a while after every write, like a
+    terminal or pipe that is not keeping up."""
+
+    def __init__(self, path, delay):
+        """Initialize a handler writing to a path."""
+        super().__init__(path)
+        self.delay = delay
+
+    def emit(self, record):
+        """Write a record, then block."""
+        super().emit(record)
+        time.sleep(self.delay)
+
+def logged(setup, path, delay, results):
+    """Measure serve loop throughput with logging set up one way, writing to
+    a file. Target of a process, so every setup starts from scratch."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(Slow(path, delay))
+    root.setLevel(logging.NOTSET)
+    loop = noisy
+    if setup == "none":
+        loop = pychat.Server.serve
+    elif setup == "disabled":
+        root.setLevel(logging.CRITICAL)
+    elif setup == "background":
+        pychat.background(logging.NOTSET, burst=sys.maxsize)
+    elif setup == "limited":
+        pychat.background(logging.NOTSET)
+    cpu, rate = dispatch(loop, idle=0.1)
+    if pychat.LISTENER:
+        pychat.LISTENER.stop()
+    results.put(rate)
+
+def logs(number=100000, delays=(0, 0.0001)):
+    """Compare serve loop throughput when every message logs an error, with
+    records written synchronously, handed to the background writer, and
+    rate limited there, against the loop without logging. Each write
+    blocks for each of DELAYS seconds in turn."""
+    directory = tempfile.mkdtemp(prefix="pychat-")
+    path = os.path.join(directory, "log")
+    results = multiprocessing.Queue()
+    rows = []
+    for setup in ("none", "disabled", "sync", "background", "limited"):
+        row = [setup]
+        for delay in delays:
+            process = multiprocessing.Process(
+                target=logged, args=(setup, path, delay, results))
+            process.start()
+            row.append(results.get())
+            process.join()
+            with open(path) as file:
+                lines = sum(1 for line in file)
+            os.remove(path)
+        rows.append(row + [lines])
+    os.rmdir(directory)
+    report(
+        "logs: serve loop throughput logging an error per message",
+        ("logging",) + tuple("msg/s %gms" % (delay * 1e3) for delay in delays)
+        + ("lines written",), rows)
+    handler = pychat.Server(("127.0.0.1", 0), history=None)
+    root = logging.getLogger()
+    level, root.level = root.level, logging.WARNING
+    eager = best(lambda: logging.log(
+        logging.DEBUG, "%s: initialized", repr(handler)), number)
+    lazy = best(lambda: logging.log(
+        logging.DEBUG, "%r: initialized", handler), number)
+    root.level = level
+    report(
+        "logs: cost of a disabled debug call",
+        ("arguments", "ns"), (("eager repr", eager * 1e9),
+                              ("lazy %r", lazy * 1e9)))
+
+def template(number=50000, clients=10):
+    """Compare formatting with compiled templates and cached time stamps
+    against rendering the time with strftime for every message, alone and
+    as part of the serve loop handling a message for CLIENTS handlers."""
+    chat = pychat.new(
+        time=time.time(), template=pychat.CHAT, name=MESSAGE["name"],
+        message=MESSAGE["message"])
+    info = pychat.new(
+        time=time.time(), template=pychat.INFO, message="John joined")
+    server = pychat.Server(("127.0.0.1", 0), history=None)
+    server.handlers = {Sink() for i in range(clients)}
+    rows = []
+    for name, string in (("strftime", strftime), ("template", pychat.string)):
+        row = [name]
+        variants = []
+        for message in (chat, info):
+            message = dict(message)
+            if string is strftime: # The same template, as a dict
+                message["template"] = {
+                    "format": message["template"].format,
+                    "datefmt": message["template"].datefmt}
+            row.append(best(
+                lambda: string(message["template"], message), number) * 1e9)
+            variants.append(message)
+        original, pychat.string = pychat.string, string
+        try:
+            row.append(best(
+                lambda: server.handle(dict(variants[0])), number // 10) * 1e6)
+        finally:
+            pychat.string = original
+        rows.append(row)
+    report(
+        "template: cost of formatting a message",
+        ("formatter", "chat ns", "info ns", "handle us"), rows)
+
+def fanout(number=200):
+    """Compare the cost of one broadcast as the number of clients grows when
+    the message is encoded once against encoding it for every handler."""
+    rows = []
+    message = pychat.new(
+        time=time.time(), template=pychat.CHAT, name=MESSAGE["name"],
+        message=MESSAGE["message"])
+    for clients in (1, 10, 100, 1000):
+        server = pychat.Server(("127.0.0.1", 0), history=None)
+        server.handlers = {Sink() for i in range(clients)}
+        def each():
+            formatted = pychat.string(message["template"], message)
+            for handler in server.handlers:
+                handler.write(pychat.encode(pychat.new(message=formatted)))
+        def once():
+            formatted = pychat.string(message["template"], message)
+            server.send(pychat.new(message=formatted))
+        rate = max(1, number // clients)
+        per, shared = best(each, rate) * 1e6, best(once, rate) * 1e6
+        rows.append((clients, per, shared, per / shared))
+    report(
+        "fanout: cost of one broadcast in microseconds",
+        ("clients", "encode each", "encode once", "speedup"), rows)
+
+def traffic(number, notices=0.2) -> list:
+    """Return formatted chat lines as the client draws them, with a share of
+    repeated join and quit notices."""
+    lines = []
+    for i in range(number):
+        stamp = time.strftime("[%I:%M %p] ")
+        if i % int(1 / notices) == 0:
+            lines.append(stamp + "*user%d joined*" % (i % 50))
+        else:
+            lines.append(stamp + "*user%d*: message _number_ %d" % (i % 50, i))
+    return lines
+
+def markup(number=10000, rate=1000):
+    """Measure the cost of rendering markup into Tk spans on the interface
+    thread, and how much of each second it takes at RATE messages per
+    second. Includes inserting a frame into a real widget when a display is
+    available."""
+    if old is None:
+        print("markup: skipped, tkinter is not available\n")
+        return
+    parse = old.markup.__wrapped__
+    rows = []
+    for kind, notices in (("mixed", 0.2), ("notices", 1.0)):
+        lines = traffic(number, notices)
+        def uncached():
+            for line in lines:
+                parse(line)
+        def cached():
+            old.markup.cache_clear()
+            for line in lines:
+                old.markup(line)
+        for title, function in (("uncached", uncached), ("cached", cached)):
+            per = best(function, 1) / number
+            rows.append((
+                kind + " " + title, per * 1e6, per * rate * 100, 0.016 / per))
+    lines = traffic(number)
+    try:
+        root = old.tkinter.Tk()
+    except old.tkinter.TclError:
+        root = None
+    if root:
+        text = old.tkinter.scrolledtext.ScrolledText(root)
+        text.tag_configure("bold", font=("Verdana", 0, "bold"))
+        text.tag_configure("italics", font=("Verdana", 0, "italic"))
+        client = old.Client.__new__(old.Client)
+        client.text, client.scrollback = text, old.SCROLLBACK
+        frame = lines[:rate // 60 + 1]
+        def draw():
+            spans = []
+            for line in frame:
+                spans.extend(old.markup(line))
+                spans.extend(("\n", ()))
+            client.draw(spans)
+        per = best(draw, 20) / len(frame)
+        rows.append(("frame insert", per * 1e6, per * rate * 100, 0.016 / per))
+        root.destroy()
+    report(
+        "markup: interface thread cost per message at %d msg/s" % rate,
+        ("render", "us/msg", "% of second", "msg/frame"), rows)
+    if not root:
+        print("  (no display, widget insert not measured)\n")
+
+OLD = "old"
+
+def host(address, mode, options):
+    """Run a chat server quietly, in a process group of its own so that it
+    can be killed along with its worker processes. Target of the server
+    process."""
+    os.setpgrp()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    if mode == OLD:
+        old.server(address, **options)
+    else:
+        pychat.server(address, mode, **options)
+
+class Server:
+    """Chat server running in its own process, so that it does not share an
+    interpreter with the simulated clients."""
+
+    def __init__(self, mode, **options):
+        """Start a server in some mode, or the old server, on a free
+        localhost port."""
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.address = probe.getsockname()
+        self.mode = mode
+        if mode != OLD:
+            options.setdefault("history", None)
+            options.setdefault("rate", None)
+        self.process = multiprocessing.Process(
+            target=host, args=(self.address, mode, options))
+        self.process.start()
+        for i in range(100):
+            try:
+                probe = socket.create_connection(self.address)
+            except OSError:
+                time.sleep(0.05)
+                continue
+            probe.sendall(pychat.encode(pychat.new(name="probe")))
+            probe.close()
+            break
+
+    def stop(self):
+        """Interrupt the server so it shuts down cleanly, raising an error if
+        it has not exited within a few seconds, once it and every process it
+        started have been killed."""
+        os.kill(self.process.pid, signal.SIGINT)
+        self.process.join(5)
+        if self.process.is_alive():
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.join()
+            raise RuntimeError("%s server ignored ctrl-c" % self.mode)
+
+class Bot(pychat.AsyncClient):
+    """Client that stamps each message with its send time and records the
+    delivery latency of every stamped message it receives."""
+
+    def __init__(self, address, index, samples):
+        """Initialize a bot recording latencies into a shared list."""
+        super().__init__(address, "bot%d" % index, self.record)
+        self.samples = samples
+        self.sent = 0
+
+    def record(self, message):
+        """Record the latency of a stamped message."""
+        stamp = message["message"].rpartition(": ")[2]
+        if stamp[:1].isdigit():
+            self.samples.append(time.perf_counter() - float(stamp))
+
+    async def chat(self, rate, duration):
+        """Send RATE stamped messages per second for DURATION seconds."""
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            self.send("%.6f" % time.perf_counter())
+            self.sent += 1
+            await asyncio.sleep(1 / rate)
+
+async def drive(address, clients, rate, duration, samples) -> int:
+    """Connect CLIENTS bots, let each chat at RATE messages per second for
+    DURATION seconds, and return the number of messages sent."""
+    bots = [Bot(address, i, samples) for i in range(clients)]
+    for i in range(0, clients, 25): # Stay within the listen backlog
+        await asyncio.gather(*(bot.activate() for bot in bots[i:i + 25]))
+    await asyncio.sleep(1 + clients / 1000) # Let join notices settle
+    del samples[:]
+    await asyncio.gather(*(
+        asyncio.sleep(i / clients / rate) for i in range(clients)))
+    await asyncio.gather(*(bot.chat(rate, duration) for bot in bots))
+    await asyncio.sleep(2) # Drain deliveries in flight
+    for bot in bots:
+        bot.shutdown()
+    return sum(bot.sent for bot in bots)
+
+def load(clients=200, rate=1.0, duration=5.0, modes=None):
+    """Drive every server mode with simulated clients chatting at RATE
+    messages per second each, and report throughput and end-to-end delivery
+    latency percentiles. MODES such as "thread+async" picks the modes."""
+    rows = []
+    for mode in modes.split("+") if modes else pychat.MODES:
+        server = Server(mode)
+        samples = []
+        try:
+            sent = asyncio.run(drive(
+                server.address, clients, rate, duration, samples))
+        finally:
+            server.stop()
+        samples.sort()
+        rows.append((
+            mode, sent / duration, len(samples) / duration,
+            100 * len(samples) / max(1, sent * clients),
+            percentile(samples, 0.5) * 1e3 if samples else float("nan"),
+            percentile(samples, 0.99) * 1e3 if samples else float("nan"),
+            percentile(samples, 0.999) * 1e3 if samples else float("nan")))
+    report(
+        "load: %d clients sending %g msg/s each for %gs" % (
+            clients, rate, duration),
+        ("mode", "sent/s", "delivered/s", "% delivered", "p50 ms", "p99 ms",
+         "p999 ms"), rows)
+
+def counters(path) -> dict:
+    """Read the counters from a metrics exposition file."""
+    values = {}
+    with open(path) as file:
+        for line in file:
+            if not line.startswith("#") and "{" not in line:
+                metric, _, value = line.rpartition(" ")
+                values[metric] = float(value)
+    return values
+
+async def pace(address, clients, rate, duration, samples, path) -> float:
+    """Connect CLIENTS bots to one room and send RATE stamped messages per
+    second between them for DURATION seconds. Return frames written per
+    socket write during that time, from the server's metrics file."""
+    bots = [Bot(address, i, samples) for i in range(clients)]
+    await asyncio.gather(*(bot.activate() for bot in bots))
+    await asyncio.sleep(1) # Let join notices settle and metrics refresh
+    before = counters(path)
+    del samples[:]
+    start = time.perf_counter()
+    sent = 0
+    while time.perf_counter() < start + duration:
+        due = int((time.perf_counter() - start) * rate)
+        while sent < due:
+            bots[sent % clients].send("%.6f" % time.perf_counter())
+            sent += 1
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(1) # Drain, and let the metrics refresh
+    after = counters(path)
+    for bot in bots:
+        bot.shutdown()
+    frames = after["pychat_sent"] - before["pychat_sent"]
+    writes = after["pychat_writes"] - before["pychat_writes"]
+    return frames / max(1, writes)
+
+def coalesce(
+        clients=10, rates=(100, 1000, 5000), flushes=(0, 0.001, 0.005),
+        duration=2.0, modes="thread+async"):
+    """Send at several message rates to CLIENTS clients in one room, and
+    report frames per socket write and delivery latency for each server
+    FLUSH window."""
+    rows = []
+    directory = tempfile.mkdtemp(prefix="pychat-")
+    path = os.path.join(directory, "metrics")
+    for mode in modes.split("+"):
+        for flush in flushes:
+            for rate in rates:
+                server = Server(
+                    mode, flush=flush, metrics=path, interval=0.25)
+                samples = []
+                try:
+                    ratio = asyncio.run(pace(
+                        server.address, clients, rate, duration, samples,
+                        path))
+                finally:
+                    server.stop()
+                samples.sort()
+                rows.append((
+                    mode, flush * 1e3, rate, ratio,
+                    percentile(samples, 0.5) * 1e3
+                    if samples else float("nan"),
+                    percentile(samples, 0.99) * 1e3
+                    if samples else float("nan")))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    report(
+        "coalesce: %d clients in one room" % clients,
+        ("mode", "flush ms", "msg/s", "frames/write", "p50 ms", "p99 ms"),
+        rows)
+
+async def flood(address, clients, number) -> float:
+    """Have CLIENTS async clients, each alone in its own room, send NUMBER
+    messages as fast as they can. Return the seconds until every message
+    came back."""
+    done = asyncio.Event()
+    left = [clients * number]
+
+    def count(message):
+        if message["message"].endswith(": x"):
+            left[0] -= 1
+            if not left[0]:
+                done.set()
+
+    bots = [pychat.AsyncClient(address, "c%d" % i, count)
+            for i in range(clients)]
+    for i in range(0, clients, 25):
+        await asyncio.gather(*(bot.activate() for bot in bots[i:i + 25]))
+    for i, bot in enumerate(bots):
+        bot.send("/join r%d" % i)
+    await asyncio.sleep(1)
+    start = time.perf_counter()
+    for i in range(number):
+        for bot in bots:
+            bot.send("x")
+        await asyncio.sleep(0)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    for bot in bots:
+        bot.shutdown()
+    return elapsed
+
+def trickle(address, clients, number) -> float:
+    """Like flood, with threaded clients."""
+    done = threading.Event()
+    left = [clients * number]
+    lock = threading.Lock()
+
+    def count(message):
+        if message["message"].endswith(": x"):
+            with lock:
+                left[0] -= 1
+                if not left[0]:
+                    done.set()
+
+    bots = [pychat.Client(address, "c%d" % i, count) for i in range(clients)]
+    for i, bot in enumerate(bots):
+        bot.activate()
+        bot.send("/join r%d" % i)
+    time.sleep(1)
+    start = time.perf_counter()
+    for i in range(number):
+        for bot in bots:
+            bot.send("x")
+    done.wait()
+    elapsed = time.perf_counter() - start
+    for bot in bots:
+        bot.shutdown()
+    return elapsed
+
+def pipeline(number=20000, clients=(1, 10, 100, 500)):
+    """Push NUMBER messages in total through the headless clients of one
+    process as fast as they go, each client alone in its room, and report
+    the round trip rate of the threaded and async clients."""
+    rows = []
+    for count in clients:
+        each = max(1, number // count)
+        server = Server(pychat.ASYNC, outbox=each + pychat.REPLAY)
+        try:
+            threaded = "-"
+            if count <= 100: # A thread pair per client
+                threaded = count * each / trickle(server.address, count, each)
+            elapsed = asyncio.run(flood(server.address, count, each))
+        finally:
+            server.stop()
+        rows.append((count, threaded, count * each / elapsed))
+    report(
+        "pipeline: messages per second through one client process",
+        ("clients", "sync msg/s", "async msg/s"), rows)
+
+def stages(number=20000, clients=10, workers=2):
+    """Push NUMBER messages through servers formatting on the serve loop and
+    on a format stage of WORKERS threads or processes, and report the round
+    trip rate of each."""
+    rows = []
+    each = max(1, number // clients)
+    for label, options in (
+            ("serve loop", dict()), ("threads", dict(stage=workers)),
+            ("processes", dict(stage=workers, pool=pychat.PROCESS))):
+        for mode in (pychat.THREAD, pychat.ASYNC):
+            server = Server(mode, outbox=each + pychat.REPLAY, **options)
+            try:
+                elapsed = asyncio.run(flood(server.address, clients, each))
+            finally:
+                server.stop()
+            rows.append((mode, label, clients * each / elapsed))
+    report(
+        "stages: messages per second by where chat messages are formatted",
+        ("server", "format", "msg/s"), rows)
+
+async def storm(address, clients, silent, timeout=30.0) -> list:
+    """Open SILENT connections that never join, then have CLIENTS connect
+    and join all at once, as after a restart. Return how long each client
+    took to see its own join notice, or None if it never did."""
+    idle = [await asyncio.open_connection(*address) for i in range(silent)]
+
+    async def join(index):
+        start = time.perf_counter()
+        label = "c%05d" % index
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            writer.write(pychat.encode(pychat.new(name=label)))
+            stream = pychat.Stream()
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return None
+                stream.feed(data)
+                message = stream.next()
+                while message is not None:
+                    if label + " joined" in message.get("message", ""):
+                        return time.perf_counter() - start
+                    message = stream.next()
+        except OSError:
+            return None
+        finally:
+            if writer:
+                writer.close()
+
+    async def bounded(index):
+        try:
+            return await asyncio.wait_for(join(index), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    times = await asyncio.gather(*(bounded(i) for i in range(clients)))
+    for reader, writer in idle:
+        writer.close()
+    return times
+
+def accept(clients=500, silent=10, modes=None, backlogs=(5, pychat.BACKLOG)):
+    """Reconnect CLIENTS at once to each server, with SILENT connections
+    stuck before their handshake, and report the rate at which clients got
+    in and how long they waited, for each listen backlog. MODES such as
+    "old+thread" picks the servers."""
+    if modes is None:
+        modes = "+".join(((OLD,) if old else ()) + tuple(pychat.MODES))
+    rows = []
+    for mode in modes.split("+"):
+        for backlog in backlogs:
+            options = dict(backlog=backlog)
+            if mode != OLD: # Room for every join notice of the storm
+                options["outbox"] = 2 * clients
+            server = Server(mode, **options)
+            try:
+                start = time.perf_counter()
+                times = asyncio.run(storm(server.address, clients, silent))
+                elapsed = time.perf_counter() - start
+            finally:
+                server.stop()
+            joined = sorted(time for time in times if time is not None)
+            rows.append((
+                mode, backlog, len(joined) / elapsed, clients - len(joined),
+                percentile(joined, 0.5) * 1e3 if joined else float("nan"),
+                percentile(joined, 0.99) * 1e3 if joined else float("nan"),
+                joined[-1] * 1e3 if joined else float("nan")))
+    report(
+        "accept: %d clients reconnecting at once, %d silent" % (
+            clients, silent),
+        ("server", "backlog", "joined/s", "failed", "p50 ms", "p99 ms",
+         "max ms"), rows)
+
+def resume(clients=100, rooms=10, missed=(0, 10, 100, 1000)):
+    """Compare what the serve loop spends on a client reconnecting as a new
+    join, which announces its exit and join to its room and replays recent
+    history, against resuming its session and sending only the broadcasts it
+    missed, as the number of broadcasts since it dropped grows."""
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        server = pychat.Server(
+            ("127.0.0.1", 0), history=os.path.join(directory, "history"))
+        sinks = [Sink() for i in range(clients)]
+        for index, sink in enumerate(sinks):
+            server.enter(sink, "room%d" % (index % rooms))
+        for index in range(pychat.WINDOW):
+            server.send(pychat.new(
+                message=MESSAGE["message"]), room="room%d" % (index % rooms))
+        sink = sinks[0]
+        def rejoin():
+            for notice in (pychat.EXIT, pychat.JOIN):
+                server.send(
+                    pychat.new(message=notice % MESSAGE["name"]),
+                    room=sink.room)
+            server.recall(sink, server.replay)
+        for count in missed:
+            sink.info = dict(
+                run=server.window.run, seq=server.window.sequence - count)
+            def resumed():
+                server.catch(sink)
+            size = len(server.window.since(
+                sink.info["run"], sink.info["seq"], sink.room))
+            rows.append([count, best(resumed, 1000) * 1e6, size / 1e3])
+        joined = best(rejoin, 1000) * 1e6 # Its notices fill the window
+        server.history.close()
+    rows = [(count, joined, resumed, size) for count, resumed, size in rows]
+    report(
+        "resume: serve loop cost of one reconnect in microseconds",
+        ("missed", "new join", "resume", "resume KB"), rows)
+
+def timers(connections=(1000, 10000, 100000), turns=1000):
+    """Compare the cost per tick of keeping an idle deadline for every
+    connection on the timer wheel against scanning every deadline on each
+    tick, with deadlines spread over IDLE seconds and re-armed as they
+    expire, as handlers do."""
+    rows = []
+    spread = int(pychat.IDLE / pychat.TICK)
+    for count in connections:
+        wheel = pychat.Wheel()
+        def rearm():
+            wheel.add(pychat.IDLE, rearm)
+        for index in range(count):
+            wheel.add(pychat.TICK * (1 + index % spread), rearm)
+        def turn():
+            for alarm in wheel.turn():
+                alarm.function()
+        deadlines = [1 + index % spread for index in range(count)]
+        clock = [0]
+        def scan():
+            clock[0] += 1
+            for index, deadline in enumerate(deadlines):
+                if deadline <= clock[0]:
+                    deadlines[index] = deadline + spread
+        scanned = best(scan, max(1, turns * 1000 // count)) * 1e6
+        wheeled = best(turn, turns) * 1e6
+        rows.append((count, scanned, wheeled, scanned / wheeled))
+    report(
+        "timers: cost of one %gs tick in microseconds" % pychat.TICK,
+        ("connections", "scan", "wheel", "speedup"), rows)
+
+def search(number=1000000, rooms=10, vocabulary=20000, queries=200):
+    """Measure what indexing adds to a broadcast, then index NUMBER messages
+    of words drawn from a Zipf-like VOCABULARY across ROOMS and report how
+    long searches for common and rare words take."""
+    generator = random.Random(0)
+    words = ["w%d" % rank for rank in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    texts = ["[01:00 AM] bot: %s" % " ".join(generator.choices(
+        words, weights, k=8)) for i in range(1000)]
+    with tempfile.TemporaryDirectory() as directory:
+        servers = [pychat.Server(
+            ("127.0.0.1", 0), history=os.path.join(directory, path),
+            segment=segment) for path, segment in (
+                ("logged", None), ("indexed", pychat.SEGMENT))]
+        costs = []
+        for server in servers:
+            for room in range(rooms):
+                server.enter(Sink(), "room%d" % room)
+            count = iter(range(1 << 30))
+            def broadcast():
+                index = next(count)
+                server.send(pychat.new(message=texts[index % len(texts)]),
+                            room="room%d" % (index % rooms))
+            costs.append(best(broadcast, 2000) * 1e6)
+        server = servers[1]
+        start = time.perf_counter()
+        for index in range(number):
+            server.send(pychat.new(message=texts[index % len(texts)]),
+                        room="room%d" % (index % rooms))
+        rate = number / (time.perf_counter() - start)
+        used = collections.Counter(" ".join(texts).split())
+        rare = min(used, key=used.get)
+        rows = []
+        for label, terms in (
+                ("common", (words[0],)), ("rare", (rare,)),
+                ("two common", words[:2]), ("common rare", (words[0], rare)),
+                ("absent", ("nowhere",))):
+            times = []
+            for i in range(queries):
+                start = time.perf_counter()
+                server.find("room%d" % (i % rooms), terms)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            rows.append((label, percentile(times, 0.5) * 1e3,
+                         percentile(times, 0.99) * 1e3))
+        segments = len(server.search.segments)
+        for server in servers:
+            server.history.close()
+        server.search.close()
+    report(
+        "search: broadcast %.1fus logged, %.1fus indexed, %d msg/s indexed "
+        "into %d segments" % (costs[0], costs[1], rate, segments),
+        ("query", "p50 ms", "p99 ms"), rows)
+
+BENCHMARKS = {
+    "codec": codec, "receive": receive, "serve": serve, "fanout": fanout,
+    "template": template, "logs": logs, "markup": markup, "load": load,
+    "accept": accept, "pipeline": pipeline, "coalesce": coalesce,
+    "resume": resume, "timers": timers, "stages": stages, "search": search}
+
+def option(value):
+    """Parse a command line option value as a number where possible."""
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+if __name__ == "__main__":
+    for argument in sys.argv[1:] or BENCHMARKS:
+        name, _, options = argument.partition(":")
+        options = dict(
+            option.split("=", 1) for option in options.split(",") if option)
+        BENCHMARKS[name](**{
+            key: option(value) for key, value in options.items()})
@@ -3,7 +3,6 @@
 
 # Import
 import logging
-import pickle
 import time
 import socket
 import threading
@@ -13,6 +12,8 @@ import tkinter.scrolledtext
 import tkinter.messagebox
 import time
 import re
+import functools
+from pychat import encode, Stream
 
 # Logging
 from logging import FATAL, CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET
@@ -36,19 +37,13 @@ def Message(**data) -> dict:
     time of the message."""
     return data
 
-def encode(message) -> bytes:
-    """Convenience function for encoding messages for sending."""
-    return pickle.dumps(message)
-
-def decode(message) -> dict:
-    """Convenience function for decoding messages for receiving."""
-    return pickle.loads(message)
-
 # Server
 try: IP, PORT = socket.gethostbyname(socket.gethostname()), 50000
 except: logging.log(WARNING, "could not determine address")
 SIZE = 1024
 COMMAND = "/"
+BACKLOG = socket.SOMAXCONN
+HANDSHAKE = 5.0
 CLIENT = "client"
 SERVER = "server"
 
@@ -63,6 +58,7 @@ class Handler:
         self.socket = socket
         self.address = address
         self.server = server
+        self.stream = Stream()
         self.active = False
         self.name = ""
         logging.log(DEBUG, "%s: initialized" % repr(self))
@@ -77,14 +73,33 @@ class Handler:
         data = encode(message)
         self.socket.send(data)
 
+    def handshake(self):
+        """Read the join message and announce the client, giving up after
+        HANDSHAKE seconds so a silent client only ties up its own thread."""
+        self.socket.settimeout(self.server.handshake)
+        message = self.stream.read(self.socket)
+        self.socket.settimeout(None)
+        self.name = message["name"]
+        new = Message(
+            type=SERVER, message="*%s joined*" % self.name,
+            time=time.time(), handler=self)
+        self.server.messages.put(new)
+
     # Loop
     def recieve(self):
-        """Loop receive data from the connected client."""
+        """Loop receive data from the connected client, after the join
+        handshake."""
         logging.log(DEBUG, "%s: recieve loop started" % repr(self))
+        try:
+            self.handshake()
+        except Exception as e:
+            logging.log(WARNING, "%s: %s in handshake" % (
+                repr(self), type(e).__name__))
+            self.shutdown()
+            self.socket.close()
         while self.active:
             try:
-                data = self.socket.recv(SIZE)
-                message = decode(data)
+                message = self.stream.read(self.socket)
                 message["handler"] = self
                 self.server.messages.put(message)
             except Exception as e:
@@ -95,22 +110,15 @@ class Handler:
 
     # Main
     def activate(self):
-        """Activate the handler."""
+        """Activate the handler. The handshake runs on its own thread, so
+        the listen loop can go straight back to accepting."""
         if self.active:
             logging.log(WARNING, "%s: already activated" % repr(self))
             return
         self.active = True
-        data = self.socket.recv(SIZE)
-        message = decode(data)
-        self.name = message["name"]
-        new = Message(
-            type=SERVER, message="*%s joined*" % self.name,
-            time=time.time(), handler=self)
-        time.sleep(0.01)
-        self.server.messages.put(new)
+        self.server.handlers.append(self)
         self.recieve_thread = threading.Thread(target=self.recieve)
         self.recieve_thread.start()
-        self.server.handlers.append(self)
         logging.log(INFO, "%s: activated" % repr(self))
 
     def shutdown(self):
@@ -119,10 +127,11 @@ class Handler:
             logging.log(WARNING, "%s: already shut down" % repr(self))
             return            
         self.active = False
-        new = Message(
-            type=SERVER, message="*%s quit*" % self.name,
-            time=time.time(), handler=self)
-        self.server.messages.put(new)
+        if self.name: # Never announced if the handshake failed
+            new = Message(
+                type=SERVER, message="*%s quit*" % self.name,
+                time=time.time(), handler=self)
+            self.server.messages.put(new)
         self.server.handlers.remove(self)
         logging.log(INFO, "%s: shut down" % repr(self))
 
@@ -131,9 +140,13 @@ class Server:
     clients via sockets."""
 
     # Magic
-    def __init__(self, address):
-        """Initialize a new chat server on an address."""
+    def __init__(self, address, backlog=BACKLOG, handshake=HANDSHAKE):
+        """Initialize a new chat server on an address. Up to BACKLOG
+        connections wait to be accepted, and a client that has not joined
+        within HANDSHAKE seconds is disconnected."""
         self.address = address
+        self.backlog = backlog
+        self.handshake = handshake
         self.messages = queue.Queue()
         self.handlers = list()
         self.active = False
@@ -142,7 +155,7 @@ class Server:
             self.socket = socket.socket()
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.bind(self.address)
-            self.socket.listen(5)
+            self.socket.listen(self.backlog)
             logging.log(DEBUG, "%s: bound" % repr(self))
         except OSError as e:
             logging.log(FATAL, "%s: could not bind" % repr(self))
@@ -197,7 +210,7 @@ class Server:
                                 time=message.time())
                             self.send(new)
                         return
-                    message.pop("handler") # Can't be pickled
+                    message.pop("handler") # Can't be encoded
                     self.send(message)
             except Exception as e:
                 if self.active:
@@ -237,8 +250,8 @@ class Server:
         self.socket.close()
         logging.log(INFO, "%s: shut down" % repr(self))
 
-def server(address=("127.0.0.1", 50000)):
-    server = Server(address)
+def server(address=("127.0.0.1", 50000), **options):
+    server = Server(address, **options)
     server.activate()
 
 # Client
@@ -246,16 +259,45 @@ ESCAPE_RE = r"(?P<escape>\\(.))"
 BOLD_RE = r"(?P<bold>\*([^\*]+)\*)"
 ITALICS_RE = r"(?P<italics>_([^_]+)_)"
 COMPILED_RE = "|".join((ESCAPE_RE, BOLD_RE, ITALICS_RE))
+MARKUP = re.compile(COMPILED_RE)
+TAGS = {"escape": (), "bold": ("bold",), "italics": ("italics",)}
+CACHE = 4096
+SCROLLBACK = 1000
+FRAME = 16
+UPDATE = "<<Update>>"
+
+@functools.lru_cache(maxsize=CACHE)
+def markup(string) -> tuple:
+    """Parse escapes, *bold* and _italics_ in a string into alternating text
+    and tag tuples, ready to pass to Text.insert. Cached, since notices like
+    joins and quits repeat."""
+    spans = []
+    position = 0
+    for match in MARKUP.finditer(string):
+        if match.start() > position:
+            spans.extend((string[position:match.start()], ()))
+        spans.extend((match.group(match.lastindex + 1), TAGS[match.lastgroup]))
+        position = match.end()
+    if position < len(string):
+        spans.extend((string[position:], ()))
+    return tuple(spans)
 
 class Client:
     """Chat client that interacts with the chat server via sockets."""
 
     # Magic
-    def __init__(self, address, name):
-        """Initialize a new, named client connecting to a server address."""
+    def __init__(self, address, name, scrollback=SCROLLBACK, frame=FRAME):
+        """Initialize a new, named client connecting to a server address. The
+        interface keeps the last SCROLLBACK lines and redraws at most once
+        every FRAME milliseconds."""
         self.address = address
         self.name = name
+        self.scrollback = scrollback
+        self.frame = frame
         self.messages = queue.Queue()
+        self.waiting = False
+        self.root = None
+        self.stream = Stream()
         self.active = False
         self.failed = False
         try:
@@ -288,12 +330,15 @@ class Client:
             state="disabled", font=("Verdana", 0))
         self.text.pack(fill="both", expand=2)
         self.text.config(height=30)
+        self.text.tag_configure("bold", font=("Verdana", 0, "bold"))
+        self.text.tag_configure("italics", font=("Verdana", 0, "italic"))
         self.entry = tkinter.Text(
             self.root, bd=1, width=40, height=3, relief="sunken",
             highlightcolor="white", font=("Verdana", 0))
         self.entry.pack(fill="x")
         logging.log(DEBUG, "%s: built" % repr(self))
         self.entry.bind("<Return>", self.input)
+        self.root.bind(UPDATE, self.schedule)
         self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
         self.update()
         self.root.mainloop()
@@ -315,12 +360,23 @@ class Client:
             return "break"
 
     def print(self, string, end="\n"):
-        """Print a string to the graphical interface."""
+        """Print a string to the graphical interface, rendering its markup."""
+        self.draw(markup(string) + (end, ()))
+
+    def draw(self, spans):
+        """Insert alternating text and tag tuples into the graphical interface
+        in a single call."""
         self.text.config(state="normal")
-        start = self.text.index("end")        
-        self.text.insert("end", string + end)
+        self.text.insert("end", *spans)
+        self.trim()
         self.text.config(state="disabled")
 
+    def trim(self):
+        """Delete the oldest lines beyond the scrollback limit in one go."""
+        lines = int(self.text.index("end-1c").split(".")[0])
+        if lines > self.scrollback:
+            self.text.delete("1.0", "%d.0" % (lines - self.scrollback + 1))
+
     def clear(self):
         """Clear the entire graphical interface."""
         self.text.config(state="normal")
@@ -333,34 +389,58 @@ class Client:
         logging.log(DEBUG, "%s: recieve loop started" % repr(self))
         while self.active:
             try:
-                data = self.socket.recv(SIZE)
-                message = decode(data)
+                message = self.stream.read(self.socket)
                 self.messages.put(message)
+                self.wake()
             except Exception as e:
                 logging.log(ERROR, "%s: %s in recieve" % (
                     repr(self), type(e).__name__))
                 if self.active:
                     self.shutdown()
 
+    def wake(self):
+        """Wake the interface up to draw, unless a wakeup is already pending.
+        Called from the receive thread."""
+        if self.waiting:
+            return
+        self.waiting = True
+        if self.root:
+            try:
+                self.root.event_generate(UPDATE, when="tail")
+            except (tkinter.TclError, RuntimeError):
+                self.waiting = False # Drawn on a later wakeup instead
+
+    def schedule(self, event=None):
+        """Schedule an update for the next frame, so that every message
+        arriving in between is drawn at once."""
+        self.root.after(self.frame, self.update)
+
     def update(self):
-        """Update the graphical interface with any new messages."""
+        """Update the graphical interface with all pending messages, inserted
+        as a single block."""
+        self.waiting = False
         if not self.active:
             self.unbuild()
+            return
+        spans = []
         while not self.messages.empty():
             message = self.messages.get()
             MESSAGE = CLIENT_MESSAGE
             if message.get("type") == SERVER:
                 if message["message"] == COMMAND + "shutdown":
                     logging.log(FATAL, "%s: server shut down" % repr(self))
+                    if spans:
+                        self.draw(spans)
                     self.shutdown()
                     return
                 else:
                     MESSAGE = SERVER_MESSAGE
             time_ = time.localtime(message["time"])
-            message_ = time.strftime(MESSAGE, time_) % message
-            self.print(message_)
-        self.root.after(50, self.update)
-    
+            spans.extend(markup(time.strftime(MESSAGE, time_) % message))
+            spans.extend(("\n", ()))
+        if spans:
+            self.draw(spans)
+
     # Main       
     def activate(self):
         """Activate the client."""        
@@ -386,6 +466,7 @@ class Client:
             logging.log(WARNING, "%s: already shut down" % repr(self))
             return
         self.active = False
+        self.wake()
         message = Message(
             name=self.name, type=CLIENT, message="/quit", time=time.time())
         self.send(message)
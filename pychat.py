@@ -2,17 +2,101 @@
 # Noah K, Haron A
 
 # Import
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import hmac
+import itertools
 import logging
-import time
+import logging.handlers
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import socket
+import struct
+import tempfile
+import threading
+import time
 
 # Logging
-from logging import FATAL, CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET
+from logging import FATAL, CRITICAL, ERROR, WARNING, DEBUG, NOTSET
 FORMAT = "%(asctime)s %(levelname)s: %(message)s"
 DATEFMT = "%m/%d/%y %I:%M:%S %p"
 LEVEL = NOTSET
+BURST = 10
+PERIOD = 1.0
 logging.basicConfig(format=FORMAT, datefmt=DATEFMT, level=LEVEL)
 
+class Limit(logging.Filter):
+    """Rate limits repeated records, such as one error per disconnecting
+    client. Passes up to BURST records with the same level and unformatted
+    message per PERIOD seconds, and notes how many were suppressed on the
+    first one passed after that."""
+
+    # Magic
+    def __init__(self, burst=BURST, period=PERIOD):
+        """Initialize a filter passing BURST records per PERIOD seconds."""
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.windows = dict()
+
+    # Function
+    def filter(self, record) -> bool:
+        """Return whether to pass a record."""
+        key = record.levelno, record.msg
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= self.period:
+            if window and window[2]:
+                record.msg = "%s (%d more suppressed)" % (
+                    record.msg, window[2])
+            self.windows[key] = [record.created, 1, 0]
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+class Background(logging.handlers.QueueHandler):
+    """Hands records to a background thread as they are, leaving formatting
+    and writing to it, where QueueHandler would format in the caller."""
+
+    # Function
+    def prepare(self, record):
+        """Return the record unformatted."""
+        return record
+
+LISTENER = None
+
+def background(level=LEVEL, burst=BURST, period=PERIOD):
+    """Log through a queue: records are rate limited and queued on the
+    logging thread, and formatted and written by a background thread
+    through the root logger's existing handlers. Also sets the root level,
+    since records below it are never even created."""
+    global LISTENER
+    root = logging.getLogger()
+    root.setLevel(level)
+    if LISTENER:
+        return LISTENER
+    records = queue.SimpleQueue()
+    LISTENER = logging.handlers.QueueListener(
+        records, *root.handlers, respect_handler_level=True)
+    handler = Background(records)
+    handler.addFilter(Limit(burst, period))
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    LISTENER.start()
+    atexit.register(LISTENER.stop)
+    return LISTENER
+
 # Utility
 def name(obj) -> str:
     """Return the name of an object's type."""
@@ -22,30 +106,445 @@ def censor(ip, parts=2) -> str:
     """Censor an ip for privacy, blocking the specified number of parts."""
     return ".".join(ip.split(".")[:-parts] + parts * ["***"])
 
+# Template
+FIELD = re.compile(r"%\((\w+)\)s|%%")
+SECONDS = re.compile(r"%[-#]?[STXcrsf+]") # Directives finer than a minute
+STAMPS = 64
+
+class Template:
+    """Message template compiled once into a formatter. FORMAT is a
+    printf-style string of %(field)s placeholders where %(datefmt)s is the
+    message time rendered with DATEFMT, and rendered times are cached per
+    minute, or per second if DATEFMT shows seconds. Formats using other
+    conversions still work, through the % operator."""
+
+    # Magic
+    def __init__(self, format, datefmt=None):
+        """Compile a template from a format string and strftime format."""
+        self.format = format
+        self.datefmt = datefmt
+        self.period = 60 if datefmt and not SECONDS.search(datefmt) else 1
+        self.stamps = dict()
+        self.render = self.compile()
+
+    def __repr__(self):
+        """Return repr(template)."""
+        return "Template<%r>" % self.format
+
+    def __call__(self, message) -> str:
+        """Format a message."""
+        if not self.datefmt:
+            return self.render(None, message)
+        bucket = int(message["time"] // self.period)
+        stamp = self.stamps.get(bucket)
+        if stamp is None:
+            stamp = self.stamp(bucket)
+        return self.render(stamp, message)
+
+    # Function
+    def compile(self):
+        """Return a function of a time stamp and a message producing the
+        formatted string. Literal text and field names are passed in as
+        names rather than spliced into the source, so nothing in the format
+        can reach the compiler."""
+        namespace = dict()
+        parts = []
+        text = ""
+        position = 0
+        for match in FIELD.finditer(self.format):
+            text += self.format[position:match.start()]
+            position = match.end()
+            if not match.group(1):
+                text += "%"
+                continue
+            namespace["_%d" % len(namespace)] = text
+            parts.append("{_%d}" % (len(namespace) - 1))
+            text = ""
+            if match.group(1) == "datefmt" and self.datefmt:
+                parts.append("{stamp}")
+            else:
+                namespace["_%d" % len(namespace)] = match.group(1)
+                parts.append("{message[_%d]}" % (len(namespace) - 1))
+        text += self.format[position:]
+        if "%" in FIELD.sub("", self.format):
+            return self.fallback # Other conversions, such as %(count)d
+        namespace["_%d" % len(namespace)] = text
+        parts.append("{_%d}" % (len(namespace) - 1))
+        return eval("lambda stamp, message: f'%s'" % "".join(parts), namespace)
+
+    def fallback(self, stamp, message) -> str:
+        """Format a message with the % operator, for formats using
+        conversions other than %(field)s."""
+        if self.datefmt:
+            message["datefmt"] = stamp
+        return self.format % message
+
+    def stamp(self, bucket) -> str:
+        """Render and cache the time stamp of a minute, or second, for the
+        messages that fall into it."""
+        if len(self.stamps) >= STAMPS:
+            self.stamps.clear()
+        stamp = self.stamps[bucket] = time.strftime(
+            self.datefmt, time.localtime(bucket * self.period))
+        return stamp
+
+def string(template, message) -> str:
+    """Convenience function for formatting messages as strings, with a
+    Template or a dict of its arguments."""
+    if type(template) is dict:
+        key = template["format"], template.get("datefmt")
+        if key not in TEMPLATES:
+            TEMPLATES[key] = Template(*key)
+        template = TEMPLATES[key]
+    return template(message)
+
+TEMPLATES = dict()
+
+def render(jobs) -> list:
+    """Format (index, format, datefmt, message) jobs into (index, string)
+    pairs. Runs in the format stage, which may be another process, so
+    templates travel as their format strings."""
+    return [
+        (index, string(dict(format=format, datefmt=datefmt), message))
+        for index, format, datefmt, message in jobs]
+
 # Message
 JOIN = "%s joined"
 EXIT = "%s exited"
-CHAT = {"format": "[%(datefmt)s] %(name)s: %(message)s", "datefmt": "%I:%M %p"}
-INFO = {"format": "[%(datefmt)s] %(message)s", "datefmt": "%I:%M %p"}
-EMPTY = {"format": "%(message)s"}
+LEFT = "%s left"
+UNKNOWN = "unknown command %s"
+USAGE = "usage: %s"
+TAKEN = "%s is taken, joined as %s"
+NOBODY = "no one named %s"
+CHAT = Template("[%(datefmt)s] %(name)s: %(message)s", "%I:%M %p")
+PRIVATE = Template(
+    "[%(datefmt)s] %(name)s to %(target)s: %(message)s", "%I:%M %p")
+INFO = Template("[%(datefmt)s] %(message)s", "%I:%M %p")
+EMPTY = Template("%(message)s")
 
 def new(**info) -> dict:
     """Convenience function for creating new messages."""
     return info
 
 def encode(message) -> bytes:
-    """Convenience function for pickling messages."""
-    return pickle.dumps(message)
+    """Convenience function for encoding messages as length-prefixed frames."""
+    body = pack(message)
+    return HEADER.pack(len(body)) + body
 
-def decode(message) -> dict:
-    """Convenience function for unpickling messages."""
-    return pickle.loads(message)
+def decode(message, start=0, end=None) -> dict:
+    """Convenience function for decoding the body of a frame, optionally
+    from START to END of a larger buffer without copying it out."""
+    return unpack(message, start, end)
 
-def string(template, message) -> str:
-    """Convenience function for formatting messages as strings."""
-    if template.get("datefmt"):
-        message["datefmt"] = time.strftime(template["datefmt"], message["time"])
-    return template["format"] % message
+# Wire
+HEADER = struct.Struct("!I")
+LENGTH = struct.Struct("!I")
+INTEGER = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+LIMIT = 1 << 20
+BUFFER = 1 << 12 # Initial receive buffer per connection
+STR, INT, REAL, NONE, TRUE, FALSE = b"sifnTF"
+TAGS = {True: bytes((TRUE,)), False: bytes((FALSE,)), None: bytes((NONE,))}
+KEYS = dict()
+
+def pack(message) -> bytes:
+    """Pack a flat message of str, int, float, bool and None values into the
+    binary body format. Each field is a one byte key length, the key, a one
+    byte type tag and the value."""
+    parts = []
+    for key, value in message.items():
+        prefix = KEYS.get(key)
+        if prefix is None:
+            prefix = KEYS[key] = bytes((len(key.encode()),)) + key.encode()
+        kind = type(value)
+        if kind is str:
+            value = value.encode()
+            parts.append(prefix + b"s" + LENGTH.pack(len(value)) + value)
+        elif kind is float:
+            parts.append(prefix + b"f" + FLOAT.pack(value))
+        elif kind is int:
+            parts.append(prefix + b"i" + INTEGER.pack(value))
+        elif kind is bool or value is None:
+            parts.append(prefix + TAGS[value])
+        else:
+            raise TypeError("cannot pack %s field %r" % (name(value), key))
+    return b"".join(parts)
+
+def unpack(data, offset=0, end=None) -> dict:
+    """Unpack a binary body, or the part of a buffer from OFFSET to END, into
+    a message. Raises ValueError on malformed input, which never executes or
+    constructs anything but plain values."""
+    message = {}
+    if end is None:
+        end = len(data)
+    length, integer, real = (
+        LENGTH.unpack_from, INTEGER.unpack_from, FLOAT.unpack_from)
+    try:
+        while offset < end:
+            size = data[offset]
+            offset += 1
+            key = str(data[offset:offset + size], "utf-8")
+            offset += size
+            tag = data[offset]
+            offset += 1
+            if tag == STR:
+                size, = length(data, offset)
+                offset += 4
+                value = str(data[offset:offset + size], "utf-8")
+                offset += size
+            elif tag == REAL:
+                value, = real(data, offset)
+                offset += 8
+            elif tag == INT:
+                value, = integer(data, offset)
+                offset += 8
+            elif tag == NONE:
+                value = None
+            elif tag == TRUE or tag == FALSE:
+                value = tag == TRUE
+            else:
+                raise ValueError("unknown tag %r" % tag)
+            message[key] = value
+    except (IndexError, struct.error) as e:
+        raise ValueError("truncated message") from e
+    if offset != end:
+        raise ValueError("truncated message")
+    return message
+
+class Stream:
+    """Reassembles length-prefixed frames from a connection, so messages split
+    across reads or sharing a single read are decoded intact. Data is received
+    straight into one preallocated buffer per connection and frames are
+    decoded in place, so reading allocates nothing but the decoded
+    messages."""
+
+    # Magic
+    def __init__(self, histogram=None, size=BUFFER):
+        """Initialize an empty stream buffer of SIZE bytes, optionally timing
+        every decode into a histogram. The buffer only grows for frames that
+        do not fit in it."""
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First byte not yet parsed
+        self.end = 0 # End of the received data
+        self.histogram = histogram
+
+    # Function
+    def next(self, raw=False):
+        """Return the next buffered message, or None if no complete frame has
+        arrived yet. RAW returns the whole frame as bytes without decoding."""
+        if self.end - self.start < HEADER.size:
+            return None
+        size, = HEADER.unpack_from(self.buffer, self.start)
+        if size > LIMIT:
+            raise ValueError("frame of %d bytes exceeds limit" % size)
+        end = self.start + HEADER.size + size
+        if end > self.end:
+            if end > len(self.buffer):
+                self.reserve(HEADER.size + size)
+            return None
+        if raw:
+            message = bytes(self.view[self.start:end])
+        elif self.histogram:
+            start = time.perf_counter()
+            message = decode(self.buffer, self.start + HEADER.size, end)
+            self.histogram.observe(time.perf_counter() - start)
+        else:
+            message = decode(self.buffer, self.start + HEADER.size, end)
+        if end == self.end: # Everything parsed, so start over for free
+            self.start = self.end = 0
+        else:
+            self.start = end
+        return message
+
+    def reserve(self, size):
+        """Make room for SIZE bytes from the first unparsed byte. Unparsed
+        data is only moved to the front when it would not fit otherwise, and
+        the buffer only replaced when SIZE exceeds it."""
+        if self.start + size <= len(self.buffer):
+            return
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def feed(self, data):
+        """Append data received elsewhere, such as from an asyncio stream."""
+        self.reserve(self.end - self.start + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def receive(self, socket):
+        """Receive into the free end of the buffer, at least SIZE bytes of
+        it."""
+        if len(self.buffer) - self.end < SIZE:
+            self.reserve(self.end - self.start + SIZE)
+        count = socket.recv_into(self.view[self.end:])
+        if not count:
+            raise EOFError("connection closed")
+        self.end += count
+
+    def read(self, socket, raw=False):
+        """Return the next message from a blocking socket, receiving more data
+        only when no complete frame is buffered."""
+        message = self.next(raw)
+        while message is None:
+            self.receive(socket)
+            message = self.next(raw)
+        return message
+
+# Metrics
+BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))
+INTERVAL = 10.0
+SLOWEST = 5
+
+class Counter:
+    """Monotonic count. Updates are unlocked to stay cheap on hot paths, so a
+    concurrent increment can very rarely be lost."""
+
+    # Magic
+    def __init__(self):
+        """Initialize a counter at zero."""
+        self.value = 0
+
+    # Function
+    def inc(self, amount=1):
+        """Increment the counter."""
+        self.value += amount
+
+class Histogram:
+    """Distribution of durations in seconds over fixed, doubling buckets from
+    a microsecond to several seconds. Unlocked, like Counter."""
+
+    # Magic
+    def __init__(self):
+        """Initialize an empty histogram."""
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    # Function
+    def observe(self, value):
+        """Record a duration."""
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        """Add the observations of another histogram to this one."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, fraction) -> float:
+        """Return the upper bound of the bucket holding a quantile."""
+        rank = fraction * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank and total:
+                return BOUNDS[i] if i < len(BOUNDS) else float("inf")
+        return 0.0
+
+class Metrics:
+    """Registry of named counters, histograms and gauges, rendered as a short
+    summary or in the Prometheus text exposition format."""
+
+    # Magic
+    def __init__(self, prefix="pychat"):
+        """Initialize an empty registry whose metric names share a prefix."""
+        self.prefix = prefix
+        self.metrics = dict()
+        self.help = dict()
+
+    # Function
+    def counter(self, name, help) -> Counter:
+        """Register and return a new counter."""
+        self.metrics[name], self.help[name] = Counter(), help
+        return self.metrics[name]
+
+    def histogram(self, name, help) -> Histogram:
+        """Register and return a new histogram."""
+        self.metrics[name], self.help[name] = Histogram(), help
+        return self.metrics[name]
+
+    def gauge(self, name, help, function):
+        """Register a gauge whose value is read from a function whenever the
+        metrics are rendered. The function may also return a histogram, or a
+        dict of values by label such as 'handler="1.2.3.4"'."""
+        self.metrics[name], self.help[name] = function, help
+
+    def items(self):
+        """Yield the name and current value of every metric, reading
+        gauges."""
+        for name, metric in self.metrics.items():
+            yield name, metric() if callable(metric) else metric
+
+    def summary(self) -> str:
+        """Return one line per metric, with p50 and p99 for histograms."""
+        lines = []
+        for name, metric in self.items():
+            if type(metric) is Histogram:
+                lines.append("%s: p50 %s p99 %s (%d)" % (
+                    name, duration(metric.quantile(0.5)),
+                    duration(metric.quantile(0.99)), metric.count))
+            elif type(metric) is Counter:
+                lines.append("%s: %d" % (name, metric.value))
+            elif type(metric) is dict:
+                lines.append("%s: %s" % (name, ", ".join(
+                    "%s %s" % (label, duration(value))
+                    for label, value in metric.items())))
+            else:
+                lines.append("%s: %s" % (name, metric))
+        return "\n".join(lines)
+
+    def exposition(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in self.items():
+            full = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (full, self.help[name]))
+            if type(metric) is Counter:
+                lines.append("# TYPE %s counter" % full)
+                lines.append("%s %s" % (full, metric.value))
+            elif type(metric) is Histogram:
+                lines.append("# TYPE %s histogram" % full)
+                total = 0
+                for bound, count in zip(BOUNDS + ("+Inf",), metric.counts):
+                    total += count
+                    lines.append(
+                        '%s_bucket{le="%s"} %d' % (full, bound, total))
+                lines.append("%s_sum %r" % (full, metric.sum))
+                lines.append("%s_count %d" % (full, metric.count))
+            elif type(metric) is dict:
+                lines.append("# TYPE %s gauge" % full)
+                for label, value in metric.items():
+                    lines.append("%s{%s} %r" % (full, label, value))
+            else:
+                lines.append("# TYPE %s gauge" % full)
+                lines.append("%s %r" % (full, metric))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically replace a file with the exposition."""
+        with open(path + ".tmp", "w") as file:
+            file.write(self.exposition())
+        os.replace(path + ".tmp", path)
+
+def duration(seconds) -> str:
+    """Format a duration in seconds for people to read."""
+    if seconds >= 1:
+        return "%.2fs" % seconds
+    if seconds >= 1e-3:
+        return "%.2fms" % (seconds * 1e3)
+    return "%.0fus" % (seconds * 1e6)
 
 # Server
 IP = socket.gethostbyname(socket.gethostname())
@@ -53,6 +552,620 @@ PORT = 50000
 ADDRESS = (IP, PORT)
 SIZE = 1024
 COMMAND = "/"
+BACKLOG = socket.SOMAXCONN
+HANDSHAKE = 5.0
+LOBBY = "lobby"
+JOINED = "join"
+EXITED = "exit"
+LAPSED = "lapse"
+PING = "ping"
+PONG = "pong"
+HEARTBEAT = encode(new(event=PING))
+ANSWER = encode(new(event=PONG))
+ADMITTED = "admit"
+HISTORY = "history.log"
+RECENT = 100
+REPLAY = 20
+RECALL = 1000
+SEGMENT = 1 << 18 # Index postings held in memory before flushing a segment
+RESULTS = 20
+WORD = re.compile(r"\w+")
+STAMP = re.compile(r"\[[^]]*\] ") # Time stamp that templates begin with
+ENTRY = struct.Struct("=QIQI") # Key position and size, postings ditto
+FOOTER = struct.Struct("=QIQI") # Directory, keys, offset indexed to, level
+MERGE = 8 # Index segments of a level merged into one of the next
+WINDOW = 4096 # Broadcasts kept for resuming sessions
+GRACE = 10.0 # Seconds a session can be resumed for
+IDLE = 30.0 # Seconds of silence before a client is pinged
+TIMEOUT = 10.0 # Seconds a pinged client has to answer
+TICK = 0.1 # Seconds per turn of the timer wheel
+SLOTS = 64 # Slots per level of the timer wheel
+LEVELS = 4 # Levels of the timer wheel, each SLOTS times coarser
+THREAD = "thread"
+ASYNC = "async"
+CLUSTER = "cluster"
+WORKERS = os.cpu_count() or 1
+PROCESS = "process"
+STAGE = 0 # Format stage workers, or 0 to format on the serve loop
+DEPTH = 64 # Batches in flight between the serve loop and delivery
+BATCH = 64
+LINGER = 0.0
+OUTBOX = 256
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+DISCONNECT = "disconnect"
+POLICY = DROP_OLDEST
+FLUSH = 0.0
+RATE = 10.0 # Messages per second per connection
+BUCKET = 20 # Messages per connection in a burst
+THROTTLE = "throttle"
+DROP = "drop"
+FLOOD = THROTTLE
+IOV = 1024 # Buffers per sendmsg, within IOV_MAX on common platforms
+
+def writev(socket, buffers) -> int:
+    """Write buffers to a socket in as few system calls as possible, using
+    scatter/gather sendmsg where available and resuming after partial
+    writes. Return the number of system calls made."""
+    if not hasattr(socket, "sendmsg"):
+        socket.sendall(b"".join(buffers))
+        return 1
+    buffers = [memoryview(buffer) for buffer in buffers]
+    calls = 0
+    start = 0
+    while start < len(buffers):
+        sent = socket.sendmsg(buffers[start:start + IOV])
+        calls += 1
+        while start < len(buffers) and sent >= len(buffers[start]):
+            sent -= len(buffers[start])
+            start += 1
+        if sent:
+            buffers[start] = buffers[start][sent:]
+    return calls
+
+class Bucket:
+    """Token bucket refilling at RATE tokens per second up to SIZE, for
+    limiting how fast messages are accepted."""
+
+    # Magic
+    def __init__(self, rate, size):
+        """Initialize a full bucket."""
+        self.rate = rate
+        self.size = size
+        self.tokens = size
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function
+    def take(self) -> float:
+        """Take a token, returning 0 if there was one, or otherwise how many
+        seconds until there will be."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.size, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def give(self):
+        """Put back a token taken for a message that was refused anyway."""
+        with self.lock:
+            self.tokens = min(self.size, self.tokens + 1)
+
+class Alarm:
+    """Callback scheduled on a timer wheel."""
+
+    # Magic
+    def __init__(self, due, function, args):
+        """Initialize an alarm for the wheel turn it is due on."""
+        self.due = due
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    # Function
+    def cancel(self):
+        """Cancel the alarm. It stays in its slot until the wheel reaches
+        it, so this is constant time."""
+        self.cancelled = True
+
+class Wheel:
+    """Hierarchical timer wheel turning every TICK seconds. Each of LEVELS
+    levels has SLOTS slots, each level SLOTS times coarser than the one
+    below, and alarms cascade down a level as their time comes closer.
+    Adding or cancelling an alarm is constant time, and a turn only touches
+    the alarms in one slot, however many are pending."""
+
+    # Magic
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS):
+        """Initialize an empty wheel starting now."""
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[list() for i in range(slots)] for i in range(levels)]
+        self.sizes = [slots ** level for level in range(levels + 1)]
+        self.turns = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Return repr(wheel)."""
+        return "Wheel<%d>" % self.turns
+
+    # Function
+    def add(self, delay, function, *args) -> Alarm:
+        """Call a function with some arguments after DELAY seconds, rounded
+        up to the next turn, and return an alarm that can be cancelled.
+        Delays beyond the top level are cut short to fit."""
+        turns = min(max(1, -int(-delay // self.tick)), self.sizes[-1] - 1)
+        with self.lock:
+            alarm = Alarm(self.turns + turns, function, args)
+            self.place(alarm)
+        return alarm
+
+    def place(self, alarm):
+        """Put an alarm in the slot of the lowest level whose span reaches
+        its due turn. Called with the lock held."""
+        span = alarm.due - self.turns
+        for level, slots in enumerate(self.levels):
+            if span < self.sizes[level + 1]:
+                slots[alarm.due // self.sizes[level] % self.slots].append(
+                    alarm)
+                return
+
+    def turn(self) -> list:
+        """Advance one turn, cascading coarser slots that come due onto the
+        finer levels, and return the alarms due on it."""
+        with self.lock:
+            self.turns += 1
+            for level in range(len(self.levels) - 1, 0, -1):
+                if self.turns % self.sizes[level] == 0:
+                    index = self.turns // self.sizes[level] % self.slots
+                    alarms = self.levels[level][index]
+                    self.levels[level][index] = list()
+                    for alarm in alarms:
+                        if not alarm.cancelled:
+                            self.place(alarm)
+            index = self.turns % self.slots
+            alarms = self.levels[0][index]
+            self.levels[0][index] = list()
+        return alarms
+
+    def advance(self):
+        """Turn the wheel up to the current time, calling every alarm that
+        comes due, in order."""
+        due = int((time.monotonic() - self.start) / self.tick)
+        while self.turns < due:
+            for alarm in self.turn():
+                if not alarm.cancelled:
+                    try:
+                        alarm.function(*alarm.args)
+                    except Exception as e:
+                        logging.log(ERROR, "%r: %s in alarm", self, name(e))
+
+class Queue(queue.Queue):
+    """Message queue that hands out messages in batches, taking its lock once
+    per batch rather than once per message."""
+
+    # Function
+    def batch(self, size=BATCH, linger=LINGER) -> list:
+        """Block until a message is available, then remove and return up to
+        SIZE messages. A positive LINGER waits up to that many seconds for the
+        batch to fill, trading latency for throughput."""
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+            if linger:
+                deadline = time.monotonic() + linger
+                while self._qsize() < size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            batch = [self._get() for i in range(min(size, self._qsize()))]
+            self.not_full.notify(len(batch))
+            return batch
+
+    def wake(self):
+        """Put a None wakeup on the queue, even if it is full."""
+        with self.not_empty:
+            self._put(None)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+class History:
+    """Append-only log of broadcast frames on disk. Keeps an index of record
+    offsets and a ring of the RECENT latest frames for every room, so reading
+    history never scans the file. Older records are sliced out of a memory
+    map of the log."""
+
+    # Magic
+    def __init__(self, path, recent=RECENT):
+        """Initialize the history from the log at a path, creating it if it
+        does not exist yet."""
+        self.path = path
+        self.recent = recent
+        self.offsets = dict()
+        self.rings = dict()
+        self.lock = threading.Lock()
+        self.map = None
+        self.file = open(path, "a+b", buffering=0)
+        self.size = self.file.tell()
+        self.load()
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(history)."""
+        return "History<%s>" % self.path
+
+    # Function
+    def load(self):
+        """Rebuild the offset index and recent rings from the log, cutting off
+        a record left truncated by a crash."""
+        offset = 0
+        if self.size:
+            self.map = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            while offset + HEADER.size <= self.size:
+                size, = HEADER.unpack_from(self.map, offset)
+                end = offset + HEADER.size + size
+                if end > self.size:
+                    break
+                room = decode(self.map, offset + HEADER.size, end).get("room")
+                self.offsets.setdefault(room, array.array("Q")).append(offset)
+                offset = end
+        if offset != self.size:
+            logging.log(WARNING, "%r: truncated record dropped", self)
+            self.file.truncate(offset)
+            self.size = offset
+        for room, offsets in self.offsets.items():
+            ring = self.rings[room] = collections.deque(maxlen=self.recent)
+            ring.extend(self.slices(self.map, offsets[-self.recent:]))
+
+    def slices(self, mapping, offsets) -> list:
+        """Return the frames at some offsets of a memory map of the log."""
+        frames = list()
+        for offset in offsets:
+            size, = HEADER.unpack_from(mapping, offset)
+            frames.append(mapping[offset:offset + HEADER.size + size])
+        return frames
+
+    def append(self, data, room) -> int:
+        """Append an encoded frame broadcast to a room, returning its
+        offset."""
+        with self.lock:
+            offset = self.size
+            self.file.write(data)
+            self.offsets.setdefault(room, array.array("Q")).append(offset)
+            self.size += len(data)
+            ring = self.rings.get(room)
+            if ring is None:
+                ring = self.rings[room] = collections.deque(maxlen=self.recent)
+            ring.append(data)
+        return offset
+
+    def latest(self, room, count) -> bytes:
+        """Return up to the last COUNT frames of a room from memory, joined
+        into one buffer. Cheap enough to call from the serve loop."""
+        with self.lock:
+            ring = self.rings.get(room, ())
+            count = min(count, len(ring))
+            return b"".join(list(ring)[len(ring) - count:])
+
+    def read(self, room, count) -> bytes:
+        """Return up to the last COUNT frames of a room, joined into one
+        buffer. Frames older than the ring are sliced out of the memory map,
+        so this belongs off the serve loop."""
+        with self.lock:
+            ring = self.rings.get(room, ())
+            if count <= len(ring):
+                return b"".join(list(ring)[len(ring) - count:])
+            offsets = self.offsets[room][-count:]
+            if self.map is None or len(self.map) < self.size:
+                self.map = mmap.mmap(
+                    self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            mapping = self.map
+        return b"".join(self.slices(mapping, offsets))
+
+    def fetch(self, offsets) -> list:
+        """Return the frames at some offsets of the log. Reads from the memory
+        map, so this belongs off the serve loop."""
+        with self.lock:
+            if self.map is None or len(self.map) < self.size:
+                self.map = mmap.mmap(
+                    self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            mapping = self.map
+        return self.slices(mapping, offsets)
+
+    def close(self):
+        """Close the log."""
+        self.file.close()
+
+class Segment:
+    """Immutable part of an index on disk: the postings of every key, the
+    keys, then a directory of fixed size entries sorted by key and a footer
+    locating it. Lookups binary search the directory in a memory map, so an
+    open segment holds no memory of its own."""
+
+    # Magic
+    def __init__(self, path):
+        """Open a segment."""
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.directory, self.count, self.indexed, self.level = \
+            FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+
+    def __repr__(self):
+        """Return repr(segment)."""
+        return "Segment<%s>" % self.path
+
+    # Function
+    def get(self, key):
+        """Return the postings of a key, or None."""
+        key = key.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position, size, start, count = ENTRY.unpack_from(
+                self.map, self.directory + middle * ENTRY.size)
+            probe = self.map[position:position + size]
+            if probe < key:
+                low = middle + 1
+            elif probe > key:
+                high = middle
+            else:
+                return self.postings(start, count)
+        return None
+
+    def items(self):
+        """Yield every key and its postings, in key order."""
+        for index in range(self.count):
+            position, size, start, count = ENTRY.unpack_from(
+                self.map, self.directory + index * ENTRY.size)
+            yield self.map[position:position + size], self.postings(
+                start, count)
+
+    def postings(self, start, count):
+        """Return COUNT postings stored at a position."""
+        postings = array.array("Q")
+        postings.frombytes(self.map[start:start + count * postings.itemsize])
+        return postings
+
+    def close(self):
+        """Close the segment."""
+        self.map.close()
+
+class Index:
+    """Inverted index of the history: for every room and word, the offsets
+    of the messages containing it, oldest first. Postings build up in memory
+    and are swapped out once there are SEGMENT of them, to be written as a
+    segment on a POOL, so memory stays bounded, and messages after the last
+    segment are indexed again from the log on startup. Every MERGE segments
+    of a level are merged into one of the next, so the number of them open
+    grows with the log's logarithm. Queries walk from the newest postings
+    and stop at the first matches they need."""
+
+    # Magic
+    def __init__(self, history, segment=SEGMENT, pool=None):
+        """Initialize the index of a history from its segments and log."""
+        self.history = history
+        self.segment = segment
+        self.pool = pool
+        self.path = history.path + ".index"
+        self.terms = dict()
+        self.postings = 0
+        self.frozen = list()
+        self.segments = list()
+        self.indexed = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.load()
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(index)."""
+        return "Index<%s>" % self.path
+
+    # Function
+    def load(self):
+        """Open the segments on disk and index the rest of the log."""
+        number = 0
+        while os.path.exists("%s.%d" % (self.path, number)):
+            path = "%s.%d" % (self.path, number)
+            segment = Segment(path)
+            number += 1
+            if segment.indexed <= self.indexed: # Left over from a merge
+                segment.close()
+                os.remove(path)
+                continue
+            if segment.indexed > self.history.size: # Log was cut off
+                segment.close()
+                break
+            self.segments.append(segment)
+            self.indexed = segment.indexed
+        mapping = self.history.map
+        offset = self.indexed
+        while offset < self.history.size:
+            size, = HEADER.unpack_from(mapping, offset)
+            end = offset + HEADER.size + size
+            message = decode(mapping, offset + HEADER.size, end)
+            self.add(offset, end - offset, message.get("room"),
+                     message.get("message"))
+            offset = end
+
+    def add(self, offset, size, room, text):
+        """Index a message of some size at an offset of the log, swapping the
+        postings in memory out to be flushed if that fills it up."""
+        if type(text) is not str:
+            return
+        stamp = STAMP.match(text)
+        words = set(WORD.findall(text[stamp.end() if stamp else 0:].lower()))
+        with self.lock:
+            for word in words:
+                key = "%s\0%s" % (room, word)
+                postings = self.terms.get(key)
+                if postings is None:
+                    postings = self.terms[key] = array.array("Q")
+                postings.append(offset)
+            self.postings += len(words)
+            self.indexed = offset + size
+            if self.postings < self.segment:
+                return
+            self.frozen.append((self.terms, self.indexed))
+            self.terms = dict()
+            self.postings = 0
+        if self.pool:
+            self.pool.submit(self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write the oldest postings swapped out of memory as the next
+        segment, then merge the newest segments while MERGE of them are of
+        one level. Flushes run one at a time, in order."""
+        with self.writing:
+            if self.closed:
+                return
+            with self.lock:
+                terms, indexed = self.frozen[0]
+            path = "%s.%d" % (self.path, len(self.segments))
+            self.write(path, ((key.encode(), terms[key])
+                              for key in sorted(terms)), indexed, 0)
+            segment = Segment(path)
+            with self.lock:
+                self.segments.append(segment)
+                del self.frozen[0]
+            logging.log(DEBUG, "%r: flushed %s", self, path)
+            while len(self.segments) >= MERGE and len(set(
+                    segment.level for segment in self.segments[-MERGE:])) == 1:
+                self.merge()
+
+    def merge(self):
+        """Merge the newest MERGE segments into one of the next level, in
+        place of the first of them. Called by flush while writing."""
+        merged = self.segments[-MERGE:]
+        first = len(self.segments) - MERGE
+        path = "%s.%d" % (self.path, first)
+        self.write(path, combine(merged), merged[-1].indexed,
+                   merged[0].level + 1)
+        segment = Segment(path)
+        with self.lock:
+            self.segments[first:] = [segment]
+        for number in range(first + 1, first + MERGE):
+            os.remove("%s.%d" % (self.path, number))
+        logging.log(DEBUG, "%r: merged into %s", self, path) # Maps of the
+        # merged segments close once searches still using them are done
+
+    def write(self, path, items, indexed, level):
+        """Write keys and their postings, in key order, out as a segment
+        atomically."""
+        entries = list()
+        keys = list()
+        position = 0
+        with open(path + ".tmp", "wb") as file:
+            for key, postings in items:
+                file.write(postings)
+                entries.append([0, len(key), position, len(postings)])
+                keys.append(key)
+                position += len(postings) * postings.itemsize
+            for entry, key in zip(entries, keys):
+                file.write(key)
+                entry[0] = position
+                position += len(key)
+            file.write(b"".join(ENTRY.pack(*entry) for entry in entries))
+            file.write(FOOTER.pack(position, len(entries), indexed, level))
+        os.replace(path + ".tmp", path)
+
+    def search(self, room, words, limit=RESULTS) -> list:
+        """Return the offsets of the latest LIMIT messages in a room that
+        contain every word, newest first."""
+        keys = ["%s\0%s" % (room, word.lower()) for word in set(words)]
+        with self.lock:
+            sources = [self.terms] + [
+                terms for terms, indexed in self.frozen[::-1]
+            ] + self.segments[::-1]
+        found = list()
+        for source in sources:
+            lists = [source.get(key) for key in keys]
+            if not all(lists):
+                continue
+            lists.sort(key=len)
+            for offset in reversed(lists[0]):
+                if all(contains(postings, offset) for postings in lists[1:]):
+                    found.append(offset)
+                    if len(found) == limit:
+                        return found
+        return found
+
+    def close(self):
+        """Wait for a segment being written, then close the segments. The
+        postings not yet written out are indexed again on startup."""
+        with self.writing:
+            self.closed = True
+            for segment in self.segments:
+                segment.close()
+
+def contains(postings, offset) -> bool:
+    """Return whether sorted postings contain an offset."""
+    index = bisect.bisect_left(postings, offset)
+    return index < len(postings) and postings[index] == offset
+
+def combine(segments):
+    """Yield every key of some segments, in key order, with its postings in
+    all of them joined in the order of the segments."""
+    items = heapq.merge(
+        *(segment.items() for segment in segments), key=lambda item: item[0])
+    for key, group in itertools.groupby(items, lambda item: item[0]):
+        postings = array.array("Q")
+        for key, part in group:
+            postings.extend(part)
+        yield key, postings
+
+class Window:
+    """Ring of the SIZE latest broadcast frames, indexed by sequence number,
+    so a client that reconnects can be sent just the frames it missed.
+    Sequence numbers start over with every run of the server, so each run
+    has a random id that broadcasts carry along with them."""
+
+    # Magic
+    def __init__(self, size=WINDOW):
+        """Initialize an empty window for a new run."""
+        self.size = size
+        self.frames = [None] * size
+        self.sequence = 0
+        self.run = os.urandom(8).hex()
+
+    def __repr__(self):
+        """Return repr(window)."""
+        return "Window<%s:%d>" % (self.run, self.sequence)
+
+    # Function
+    def next(self) -> int:
+        """Return the sequence number for the next broadcast."""
+        self.sequence += 1
+        return self.sequence
+
+    def append(self, sequence, data, room):
+        """Keep a broadcast frame, overwriting the oldest one."""
+        self.frames[sequence % self.size] = (room, data)
+
+    def since(self, run, sequence, room):
+        """Return the frames broadcast to a room, or to everyone, after a
+        sequence number of a run joined into one buffer, or None if the run
+        is another one or some of the frames have already been overwritten.
+        Costs one step per missed broadcast."""
+        if run != self.run or not 0 <= self.sequence - sequence <= self.size:
+            return None
+        frames = list()
+        for index in range(sequence + 1, self.sequence + 1):
+            target, data = self.frames[index % self.size]
+            if target is None or target == room:
+                frames.append(data)
+        return b"".join(frames)
 
 class Handler:
     """Handler class for interacting with connected clients. Runs the sending
@@ -66,8 +1179,18 @@ class Handler:
         self.address = address
         self.server = server
         self.info = dict()
+        self.room = LOBBY
+        self.stream = Stream(server.decoding)
+        self.outbox = Queue(server.outbox)
+        self.latency = Histogram()
+        self.bucket = (
+            Bucket(server.rate, server.bucket) if server.rate else None)
+        self.dropped = 0
+        self.flooded = 0
+        self.seen = time.monotonic()
+        self.token = None
         self.active = False
-        logging.log(DEBUG, "%s: initialized", repr(self))
+        logging.log(DEBUG, "%r: initialized", self)
 
     def __repr__(self):
         """Return repr(handler)."""
@@ -76,127 +1199,1614 @@ class Handler:
     # Function
     def give(self, message):
         """Give a message to the parent server."""
+        self.server.received.inc()
         self.server.messages.put(message)
 
     def send(self, message):
         """Send a message to the connected client."""
-        data = encode(message)
-        self.socket.send(data)
+        self.write(encode(message))
+
+    def write(self, data):
+        """Queue an already encoded message for the transmit loop. When the
+        outbox is full the server's policy drops the oldest or newest message
+        or disconnects the client, so a slow client never blocks the server."""
+        try:
+            self.outbox.put_nowait(data)
+        except queue.Full:
+            self.overflow(data)
+
+    def overflow(self, data):
+        """Apply the server's policy to a message that found the outbox
+        full."""
+        if not self.active:
+            return
+        if self.server.policy == DISCONNECT:
+            self.server.evicted += 1
+            logging.log(WARNING, "%r: evicted as slow consumer", self)
+            self.shutdown()
+            return
+        self.dropped += 1
+        self.server.dropped += 1
+        if self.server.policy == DROP_OLDEST:
+            try:
+                self.outbox.get_nowait()
+                self.outbox.put_nowait(data)
+            except (queue.Empty, queue.Full,
+                    asyncio.QueueEmpty, asyncio.QueueFull):
+                pass
+
+    def limit(self) -> float:
+        """Take a token for a received message from the connection's bucket
+        and then the server's, returning 0 if the message may be queued, or
+        otherwise how many seconds until it could be. A token taken from the
+        connection's bucket is given back if the server's refuses."""
+        wait = self.bucket.take() if self.bucket else 0.0
+        if not wait and self.server.limiter:
+            wait = self.server.limiter.take()
+            if wait and self.bucket:
+                self.bucket.give()
+        return wait
+
+    def flood(self):
+        """Apply the server's flood policy to a message over the rate limit
+        that is not being throttled: drop it, or disconnect the client."""
+        self.flooded += 1
+        if self.server.flood == DISCONNECT:
+            self.server.expelled.inc()
+            logging.log(WARNING, "%r: disconnected for flooding", self)
+            self.shutdown()
+        else:
+            self.server.discarded.inc()
+
+    def check(self):
+        """Check on the client from the server's timer wheel: ping it after
+        IDLE seconds of silence, and reap the connection if it has still not
+        sent anything TIMEOUT seconds later, so a peer that vanished without
+        closing its connection gets the usual exit notice."""
+        if not self.active:
+            return
+        server = self.server
+        silent = time.monotonic() - self.seen
+        if silent >= server.idle + server.timeout:
+            server.reaped.inc()
+            logging.log(WARNING, "%r: reaped after %.1fs idle", self, silent)
+            self.shutdown()
+            return
+        if silent >= server.idle:
+            server.pings.inc()
+            self.write(HEARTBEAT)
+            delay = server.idle + server.timeout - silent
+        else:
+            delay = server.idle - silent
+        server.wheel.add(delay, self.check)
+
+    def accept(self, message, retry=False) -> float:
+        """Pass a message received from the client on to the server, within
+        the rate limits, returning 0 once it is dealt with, or otherwise how
+        many seconds to wait before RETRY when the server throttles floods.
+        A pong only shows the client is alive, and under the other flood
+        policies a message over the limits is dropped or disconnects."""
+        if not retry:
+            self.seen = time.monotonic()
+            if message.get("event") == PONG:
+                return 0.0
+        wait = self.limit()
+        if wait and self.server.flood == THROTTLE:
+            if not retry:
+                self.flooded += 1
+                self.server.throttled.inc()
+            return wait
+        if wait:
+            self.flood()
+            return 0.0
+        message.pop("event", None)
+        message["template"] = CHAT
+        message["handler"] = self
+        self.give(message)
+        return 0.0
+
+    def handshake(self):
+        """Read the join message, giving up after the server's HANDSHAKE
+        seconds so that a silent client only ties up its own thread."""
+        self.socket.settimeout(self.server.handshake)
+        self.join(self.stream.read(self.socket))
+        self.socket.settimeout(None)
+
+    def join(self, message):
+        """Take the client's info from its join message."""
+        if type(message.get("name")) is not str:
+            raise ValueError("join message without a name")
+        if type(message.get("seq", 0)) is not int:
+            raise ValueError("join message with a bad sequence number")
+        if type(message.get("run", "")) not in (str, type(None)):
+            raise ValueError("join message with a bad run")
+        if type(message.get("token", "")) not in (str, type(None)):
+            raise ValueError("join message with a bad token")
+        self.info = message.copy()
 
     # Loop
+    def transmit(self):
+        """Send queued messages to the connected client. Every frame queued
+        within the server's FLUSH window goes out in one write."""
+        logging.log(DEBUG, "%r: transmit loop started", self)
+        while self.active:
+            batch = self.outbox.batch(self.server.outbox, self.server.flush)
+            batch = [data for data in batch if data is not None] # Wakeups
+            if not batch:
+                continue
+            try:
+                start = time.perf_counter()
+                calls = writev(self.socket, batch)
+                self.latency.observe(time.perf_counter() - start)
+                self.server.sent.inc(len(batch))
+                self.server.writes.inc(calls)
+            except Exception as e:
+                if self.active:
+                    logging.log(
+                        ERROR, "%r: %s in transmit", self, name(e))
+                    self.shutdown()
+        logging.log(DEBUG, "%r: transmit loop finished", self)
+
     def receive(self):
         """Receive messages from the connected client. Also handles connection
         and disconnection from the server."""
-        logging.log(DEBUG, "%s: receive loop started", repr(self))
-        data = self.socket.recv(SIZE)
-        message = decode(data)
-        self.info = message.copy()
+        logging.log(DEBUG, "%r: receive loop started", self)
+        try:
+            self.handshake()
+        except Exception as e:
+            logging.log(WARNING, "%r: %s in handshake", self, name(e))
+            if self.active:
+                self.shutdown()
+            return
         message = new(
-            time=time.time(), template=INFO, message=JOIN % self.info["name"])
+            time=time.time(), template=INFO, message=JOIN % self.info["name"],
+            event=JOINED, handler=self)
         self.give(message)
-        logging.log(DEBUG, "%s: joined", repr(self))
+        logging.log(DEBUG, "%r: joined", self)
         while self.active:
             try:
-                data = self.socket.recv(SIZE)
-                message = decode(data)
-                message["handler"] = self
-                self.give(message)
+                message = self.stream.read(self.socket)
+                wait = self.accept(message)
+                while wait: # The socket backs up onto the client
+                    time.sleep(wait)
+                    wait = self.accept(message, True)
             except Exception as e:
                 if self.active:
                     logging.log(
-                        ERROR, "%s: %s in receive", repr(self), name(e))
+                        ERROR, "%r: %s in receive", self, name(e))
                     self.shutdown()
         message = new(
-            time=time.time(), template=INFO, message=EXIT % self.info["name"])
+            time=time.time(), template=INFO, message=EXIT % self.info["name"],
+            event=EXITED, handler=self)
         self.give(message)
-        logging.log(DEBUG, "%s: exited", repr(self))
-        logging.log(DEBUG, "%s: receive loop finished", repr(self))
+        logging.log(DEBUG, "%r: exited", self)
+        logging.log(DEBUG, "%r: receive loop finished", self)
 
     # Main
     def activate(self):
         """Activate the handler."""
         if self.active:
-            logging.log(WARNING, "%s: already activated", repr(self))
+            logging.log(WARNING, "%r: already activated", self)
             return
         self.active = True
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.handlers.add(self)
+        if self.server.idle:
+            self.server.wheel.add(self.server.idle, self.check)
         self.receive_thread = threading.Thread(target=self.receive)
         self.receive_thread.start()
-        self.server.handlers.append(self)
-        logging.log(INFO, "%s: activated", repr(self))
+        self.transmit_thread = threading.Thread(target=self.transmit)
+        self.transmit_thread.start()
+        logging.log(logging.INFO, "%r: activated", self)
 
     def shutdown(self):
         """Shut down the handler."""
-        if self.active:
-            logging.log(WARNING, "%s: already shut down", repr(self))
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
             return
-        self.active = True
-        self.server.handlers.remove(self)
-        logging.log(INFO, "%s: shut down", repr(self))
+        self.active = False
+        self.server.handlers.discard(self)
+        self.outbox.wake()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        logging.log(logging.INFO, "%r: shut down", self)
 
 class Server:
     """Chat server that utilizes handlers to interact with connected clients
     via sockets."""
 
     # Magic
-    def __init__(self, address):
-        """Initialize a new chat server on an address."""
+    def __init__(
+            self, address, batch=BATCH, linger=LINGER, outbox=OUTBOX,
+            policy=POLICY, history=HISTORY, replay=REPLAY, metrics=None,
+            interval=INTERVAL, backlog=BACKLOG, handshake=HANDSHAKE,
+            flush=FLUSH, rate=RATE, bucket=BUCKET, total=None, flood=FLOOD,
+            window=WINDOW, grace=GRACE, idle=IDLE, timeout=TIMEOUT,
+            stage=STAGE, pool=THREAD, depth=DEPTH, segment=SEGMENT):
+        """Initialize a new chat server on an address. The serve loop handles
+        up to BATCH messages per wakeup, waiting up to LINGER seconds for a
+        batch to fill. Each handler queues up to OUTBOX outgoing messages and
+        applies POLICY when that fills up. Broadcasts are logged to the
+        HISTORY path unless it is None, and the last REPLAY messages of a
+        room are sent to whoever joins it. If METRICS is a path, the metrics
+        are written there every INTERVAL seconds. Up to BACKLOG connections
+        wait to be accepted, and a client that has not joined within
+        HANDSHAKE seconds is disconnected. Handlers write every frame queued
+        within FLUSH seconds of the first at once. Each connection may send
+        RATE messages per second after a burst of BUCKET, and all of them
+        together TOTAL per second, unless these are None. FLOOD throttles,
+        drops or disconnects on messages over the limit. The last WINDOW
+        broadcasts are kept by sequence number, and a client that reconnects
+        within GRACE seconds is sent only the ones it missed, without any
+        exit or join notices. A client silent for IDLE seconds is pinged, and
+        disconnected if it does not answer within TIMEOUT seconds, unless
+        IDLE is None. With a STAGE of workers, threads or processes as POOL
+        says, chat messages are formatted off the serve loop, and batches
+        are delivered in order up to DEPTH behind it. The history is indexed
+        for searching, flushing SEGMENT postings at a time to disk, unless
+        SEGMENT is None."""
         self.address = address
-        self.messages = queue.Queue()
-        self.handlers = list()
+        self.messages = Queue()
+        self.handlers = set()
+        self.rooms = dict()
+        self.names = dict()
+        self.window = Window(window) if window else None
+        self.grace = grace
+        self.sessions = dict()
+        self.idle = idle
+        self.timeout = timeout
+        self.wheel = Wheel()
+        self.history = History(history) if history else None
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix=repr(self))
+        self.search = None
+        if self.history and segment:
+            self.search = Index(self.history, segment, self.pool)
+        self.replay = replay
+        self.formatter = None
+        if stage and pool == PROCESS:
+            self.formatter = concurrent.futures.ProcessPoolExecutor(stage)
+        elif stage:
+            self.formatter = concurrent.futures.ThreadPoolExecutor(
+                stage, thread_name_prefix=repr(self) + "-format")
+        self.pending = Queue(depth)
+        self.batch = batch
+        self.linger = linger
+        self.outbox = outbox
+        self.policy = policy
+        self.dropped = 0
+        self.evicted = 0
+        self.export = metrics
+        self.interval = interval
+        self.backlog = backlog
+        self.handshake = handshake
+        self.flush = flush
+        self.rate = rate
+        self.bucket = bucket
+        self.limiter = Bucket(total, total) if total else None
+        self.flood = flood
+        self.metrics = Metrics()
+        self.received = self.metrics.counter(
+            "received", "Messages received from clients.")
+        self.sent = self.metrics.counter(
+            "sent", "Frames written to client sockets.")
+        self.writes = self.metrics.counter(
+            "writes", "Write calls made to client sockets.")
+        self.decoding = self.metrics.histogram(
+            "decode_seconds", "Time to decode a received frame.")
+        self.formatting = self.metrics.histogram(
+            "format_seconds", "Time to format a message from its template.")
+        self.encoding = self.metrics.histogram(
+            "encode_seconds", "Time to encode an outgoing message.")
+        self.fanout = self.metrics.histogram(
+            "fanout_seconds", "Time to queue a broadcast for every handler.")
+        self.staging = self.metrics.histogram(
+            "stage_seconds", "Time for the format stage to finish a batch.")
+        self.indexing = self.metrics.histogram(
+            "index_seconds", "Time to index a broadcast for search.")
+        self.metrics.gauge(
+            "send_seconds", "Time to write to a client socket.",
+            self.latency)
+        self.metrics.gauge(
+            "slowest_send_seconds", "p99 send time of the slowest handlers.",
+            self.slowest)
+        self.accepted = self.metrics.counter(
+            "accepted", "Connections accepted.")
+        self.throttled = self.metrics.counter(
+            "throttled", "Messages delayed by flood control.")
+        self.discarded = self.metrics.counter(
+            "discarded", "Messages dropped by flood control.")
+        self.expelled = self.metrics.counter(
+            "expelled", "Clients disconnected by flood control.")
+        self.resumed = self.metrics.counter(
+            "resumed", "Sessions resumed within the grace period.")
+        self.pings = self.metrics.counter(
+            "pings", "Pings sent to idle clients.")
+        self.reaped = self.metrics.counter(
+            "reaped", "Connections reaped after going silent.")
+        self.metrics.gauge(
+            "queue_depth", "Messages waiting for the serve loop.",
+            lambda: self.messages.qsize())
+        self.metrics.gauge(
+            "pending", "Batches waiting to be delivered.",
+            lambda: self.pending.qsize())
+        self.metrics.gauge(
+            "handlers", "Connected handlers.", lambda: len(self.handlers))
+        self.metrics.gauge(
+            "rooms", "Rooms with at least one member.",
+            lambda: len(self.rooms))
+        self.metrics.gauge(
+            "dropped", "Messages dropped from full outboxes.",
+            lambda: self.dropped)
+        self.metrics.gauge(
+            "evicted", "Handlers disconnected as slow consumers.",
+            lambda: self.evicted)
         self.active = False
-        logging.log(DEBUG, "%s: initialized", repr(self))
+        logging.log(DEBUG, "%r: initialized", self)
 
     def __repr__(self):
         """Return repr(server)."""
         return "Server<%s>" % self.address[0]
 
+    # Metrics
+    def latency(self) -> Histogram:
+        """Return the send latency of every connected handler combined."""
+        histogram = Histogram()
+        for handler in list(self.handlers):
+            histogram.merge(handler.latency)
+        return histogram
+
+    def slowest(self) -> dict:
+        """Return the p99 send latency of the SLOWEST slowest handlers."""
+        latencies = sorted(
+            ((handler.latency.quantile(0.99), handler)
+             for handler in list(self.handlers) if handler.latency.count),
+            key=lambda pair: pair[0], reverse=True)
+        return {'handler="%s:%s"' % handler.address[:2]: latency
+                for latency, handler in latencies[:SLOWEST]}
+
     # Function
-    def send(self, message, handler=None):
-        """Broadcast a message or send it to a specific handler."""
+    def send(self, message, handler=None, room=None):
+        """Broadcast a message to a room, or everyone if no room is given, or
+        send it to a specific handler. The message is encoded once and the
+        same bytes are written to every handler. Broadcasts are stamped with
+        a sequence number and kept in the window."""
+        if not handler and self.window:
+            message["run"] = self.window.run
+            message["seq"] = self.window.next()
+        start = time.perf_counter()
+        data = encode(message)
+        self.encoding.observe(time.perf_counter() - start)
         if handler:
-            handler.send(message)
+            handler.write(data)
+        else:
+            if self.window:
+                self.window.append(message["seq"], data, room)
+            self.broadcast(data, room, message.get("message"))
+
+    def broadcast(self, data, room=None, text=None):
+        """Write an already encoded message to every handler in a room, or to
+        every handler if no room is given. Room messages are logged and
+        indexed by their TEXT, decoded from the frame if not given."""
+        if room is None:
+            handlers = list(self.handlers)
+        else:
+            handlers = list(self.rooms.get(room, ())) # Relays broadcast too
+            if self.history:
+                offset = self.history.append(data, room)
+                if self.search:
+                    start = time.perf_counter()
+                    if text is None:
+                        text = decode(data, HEADER.size).get("message")
+                    self.search.add(offset, len(data), room, text)
+                    self.indexing.observe(time.perf_counter() - start)
+        start = time.perf_counter()
+        for handler in handlers:
+            handler.write(data)
+        self.fanout.observe(time.perf_counter() - start)
+
+    def defer(self, function, *args):
+        """Run a function on the server's pool, off the serve loop, returning
+        a future."""
+        return self.pool.submit(function, *args)
+
+    def recall(self, handler, count):
+        """Send a handler the last COUNT messages of its room. Served from
+        memory when possible, and otherwise read from disk on the pool."""
+        if not self.history or count <= 0:
+            return
+        if count <= self.history.recent:
+            data = self.history.latest(handler.room, count)
+            if data:
+                handler.write(data)
+            return
+        future = self.defer(self.history.read, handler.room, count)
+        future.add_done_callback(lambda future: handler.write(future.result()))
+
+    def later(self, delay, message):
+        """Queue a message for the serve loop after DELAY seconds, returning
+        an alarm that can be cancelled."""
+        return self.wheel.add(delay, self.messages.put_nowait, message)
+
+    def catch(self, handler):
+        """Send a reconnecting handler the broadcasts to its room since the
+        last one its client saw, or its room's recent history if that was in
+        another run or the window no longer reaches back that far."""
+        data = self.window.since(
+            handler.info.get("run"), handler.info["seq"], handler.room)
+        if data is None:
+            self.recall(handler, self.replay)
+        elif data:
+            handler.write(data)
+
+    def reply(self, handler, text):
+        """Send an informational message to a specific handler."""
+        message = new(time=time.time(), message=text)
+        formatted = string(INFO, message)
+        self.send(new(message=formatted, room=handler.room), handler)
+
+    def enter(self, handler, room):
+        """Add a handler to a room. Only called from the serve loop, which
+        owns the room index."""
+        handler.room = room
+        self.rooms.setdefault(room, set()).add(handler)
+
+    def leave(self, handler):
+        """Remove a handler from its room in constant time, dropping the room
+        once it is empty."""
+        members = self.rooms.get(handler.room)
+        if members is not None:
+            members.discard(handler)
+            if not members:
+                del self.rooms[handler.room]
+
+    def register(self, handler) -> str:
+        """Index a joining handler by name so it can be found in constant
+        time. A name already in use gets the lowest free numeric suffix, and
+        the name asked for is returned if so. Only called from the serve
+        loop, which owns the name index."""
+        wanted = handler.info["name"]
+        name, suffix = wanted, 1
+        while name in self.names:
+            suffix += 1
+            name = "%s%d" % (wanted, suffix)
+        self.names[name] = handler
+        if name != wanted:
+            handler.info["name"] = name
+            return wanted
+
+    def unregister(self, handler):
+        """Remove an exiting handler from the name index."""
+        name = handler.info.get("name")
+        if self.names.get(name) is handler:
+            del self.names[name]
+
+    def hold(self, handler, message):
+        """Keep the session of a handler that exited for GRACE seconds before
+        announcing it, in case the client reconnects."""
+        self.leave(handler)
+        timer = self.later(
+            self.grace, new(event=LAPSED, handler=handler))
+        self.sessions[handler.info["name"]] = (handler, message, timer)
+
+    def admit(self, handler):
+        """Tell the client of a joined handler the name it holds and the
+        token that resumes its session."""
+        self.send(new(
+            event=ADMITTED, name=handler.info["name"], token=handler.token),
+            handler)
+
+    def resume(self, handler) -> bool:
+        """Resume the session of a joining handler that carries the token
+        its client was admitted with and the last sequence number it saw,
+        returning whether there was one. The session is either held after
+        an exit, or still open when the client reconnects before its old
+        connection is noticed to be gone, and then the old handler is shut
+        down without an exit notice. The handler takes over the name, token
+        and room and is sent what it missed."""
+        name = handler.info["name"]
+        token = handler.info.get("token")
+        if not token or not handler.info.get("seq"):
+            return False
+        if name in self.sessions:
+            previous = self.sessions[name][0]
+        else:
+            previous = self.names.get(name)
+        if (previous is None or previous is handler
+                or not hmac.compare_digest(previous.token, token)):
+            return False
+        if name in self.sessions:
+            previous, message, timer = self.sessions.pop(name)
+            timer.cancel()
         else:
-            for handler in self.handlers:
-                handler.send(message)
+            self.leave(previous)
+            previous.shutdown()
+        self.names[name] = handler
+        handler.token = previous.token
+        self.admit(handler)
+        self.enter(handler, previous.room)
+        self.catch(handler)
+        self.resumed.inc()
+        return True
+
+    def lapse(self, handler):
+        """Announce the exit of a handler whose session was not resumed."""
+        session = self.sessions.get(handler.info["name"])
+        if session is None or session[0] is not handler:
+            return
+        del self.sessions[handler.info["name"]]
+        message = session[1]
+        formatted = string(message["template"], message)
+        self.send(new(message=formatted, room=handler.room), room=handler.room)
+        self.unregister(handler)
+
+    def handle(self, message, formatted=None):
+        """Handle a message taken off the queue: track room membership on
+        join and exit, run commands and broadcast everything else to the
+        sender's room, formatted unless the format stage already did."""
+        handler = message.pop("handler", None)
+        event = message.get("event")
+        if event == JOINED:
+            if self.window and self.resume(handler):
+                return
+            taken = self.register(handler)
+            handler.token = os.urandom(16).hex()
+            self.admit(handler)
+            if taken:
+                message["message"] = JOIN % handler.info["name"]
+                self.reply(handler, TAKEN % (taken, handler.info["name"]))
+            self.enter(handler, handler.room)
+            if self.window and handler.info.get("seq"):
+                self.catch(handler)
+            else:
+                self.recall(handler, self.replay)
+        elif event == EXITED and self.names.get(
+                handler.info["name"]) is not handler:
+            return # Taken over by a reconnection with its token
+        elif event == EXITED and self.window and "seq" in handler.info:
+            self.hold(handler, message)
+            return
+        elif event == LAPSED:
+            self.lapse(handler)
+            return
+        elif handler and message["message"].startswith(COMMAND):
+            self.command(handler, message["message"][len(COMMAND):])
+            return
+        elif handler:
+            message["name"] = handler.info["name"]
+        room = handler.room if handler else None
+        if formatted is None:
+            start = time.perf_counter()
+            formatted = string(message["template"], message)
+            self.formatting.observe(time.perf_counter() - start)
+        self.send(new(message=formatted, room=room), room=room)
+        if event == EXITED:
+            self.leave(handler)
+            self.unregister(handler)
+
+    def prepare(self, batch):
+        """Submit the chat messages of a batch to the format stage, returning
+        a future of their formatted strings by index, or None if there are
+        none. Only senders whose join has been handled qualify, since that
+        can change their name."""
+        jobs = list()
+        for index, message in enumerate(batch):
+            handler = message and message.get("handler")
+            if (not handler or "event" in message
+                    or type(message.get("message")) is not str
+                    or message["message"].startswith(COMMAND)
+                    or self.names.get(handler.info["name"]) is not handler):
+                continue
+            message["name"] = handler.info["name"]
+            template = message["template"]
+            jobs.append((index, template.format, template.datefmt, {
+                key: value for key, value in message.items()
+                if key != "handler" and key != "template"}))
+        if not jobs:
+            return None
+        start = time.perf_counter()
+        future = self.formatter.submit(render, jobs)
+        future.add_done_callback(
+            lambda future: self.staging.observe(time.perf_counter() - start))
+        return future
+
+    def dispatch(self, batch, formatted=None):
+        """Handle a batch of messages in order, using any strings formatted
+        for them by index."""
+        formatted = formatted or dict()
+        for index, message in enumerate(batch):
+            if message is None: # Wakeup from shutdown
+                continue
+            try:
+                self.handle(message, formatted.get(index))
+            except Exception as e:
+                if self.active:
+                    logging.log(ERROR, "%r: %s in serve", self, name(e))
+
+    def command(self, handler, text):
+        """Run a command from a handler, such as "join lounge"."""
+        command, _, argument = text.partition(" ")
+        function = getattr(self, "do_" + command, None)
+        if function is None:
+            self.reply(handler, UNKNOWN % (COMMAND + command))
+            return
+        function(handler, argument.strip())
+
+    # Command
+    def do_join(self, handler, room):
+        """Move to another room, leaving the current one."""
+        if not room or room == handler.room:
+            self.reply(handler, USAGE % (COMMAND + "join <room>"))
+            return
+        name = handler.info["name"]
+        message = new(time=time.time(), message=LEFT % name)
+        self.send(new(
+            message=string(INFO, message), room=handler.room),
+            room=handler.room)
+        self.leave(handler)
+        self.enter(handler, room)
+        self.recall(handler, self.replay)
+        message = new(time=time.time(), message=JOIN % name)
+        self.send(new(message=string(INFO, message), room=room), room=room)
+
+    def do_leave(self, handler, argument):
+        """Leave the current room for the lobby."""
+        if handler.room == LOBBY:
+            self.reply(handler, "already in %s" % LOBBY)
+            return
+        self.do_join(handler, LOBBY)
+
+    def do_msg(self, handler, argument):
+        """Send a private message to someone by name."""
+        target, _, text = argument.partition(" ")
+        if not target or not text.strip():
+            self.reply(handler, USAGE % (COMMAND + "msg <name> <text>"))
+            return
+        recipient = self.names.get(target)
+        if recipient is None:
+            self.reply(handler, NOBODY % target)
+            return
+        message = new(
+            time=time.time(), name=handler.info["name"], target=target,
+            message=text.strip())
+        private = new(message=string(PRIVATE, message), room=recipient.room)
+        self.send(private, recipient)
+        if recipient is not handler:
+            self.send(private, handler)
+
+    def do_history(self, handler, count):
+        """Replay the last messages of the current room."""
+        if not count.isdigit() or not self.history:
+            self.reply(handler, USAGE % (COMMAND + "history <n>"))
+            return
+        self.recall(handler, min(int(count), RECALL))
+
+    def do_search(self, handler, terms):
+        """Find the latest messages in the current room with every word."""
+        words = WORD.findall(terms)
+        if not words or not self.search:
+            self.reply(handler, USAGE % (COMMAND + "search <words>"))
+            return
+        future = self.defer(self.find, handler.room, words)
+        future.add_done_callback(
+            lambda future: self.reply(handler, future.result()))
+
+    def find(self, room, words) -> str:
+        """Search a room and list the messages found, oldest first."""
+        offsets = self.search.search(room, words)
+        if not offsets:
+            return "no messages with %s" % " ".join(words)
+        frames = self.history.fetch(offsets[::-1])
+        return "%d found\n%s" % (len(frames), "\n".join(
+            decode(frame, HEADER.size).get("message", "")
+            for frame in frames))
+
+    def do_stats(self, handler, argument):
+        """Show the server's metrics and the caller's own send latency."""
+        self.reply(handler, "stats\n%s\nyour send: p50 %s p99 %s" % (
+            self.metrics.summary(), duration(handler.latency.quantile(0.5)),
+            duration(handler.latency.quantile(0.99))))
 
     # Loop
     def listen(self):
         """Listen for incoming connections from possible clients."""        
-        logging.log(DEBUG, "%s: listen loop started", repr(self))
+        logging.log(DEBUG, "%r: listen loop started", self)
         while self.active:
             try:
                 socket, address = self.socket.accept()
+                self.accepted.inc()
                 handler = Handler(socket, address, self)
                 handler.activate()
             except Exception as e:
                 if self.active:
-                    logging.log(ERROR, "%s: %s in listen", repr(self), name(e))
+                    logging.log(ERROR, "%r: %s in listen", self, name(e))
 
     def serve(self):
-        """Main server loop handles incoming messages and handles them."""
-        logging.log(DEBUG, "%s: serve loop started", repr(self))
+        """Main server loop handles incoming messages and handles them. With a
+        format stage it only hands batches on, blocking once DEPTH of them
+        are waiting to be delivered."""
+        logging.log(DEBUG, "%r: serve loop started", self)
         while self.active:
+            batch = self.messages.batch(self.batch, self.linger)
+            if self.formatter:
+                self.pending.put((batch, self.prepare(batch)))
+            else:
+                self.dispatch(batch)
+
+    def deliver(self):
+        """Handle batches from the serve loop in the order it took them, each
+        once the format stage is done with it."""
+        logging.log(DEBUG, "%r: deliver loop started", self)
+        while True:
+            item = self.pending.get()
+            if item is None: # Wakeup from shutdown, after what was queued
+                break
+            batch, future = item
+            formatted = None
+            if future:
+                try:
+                    formatted = dict(future.result())
+                except Exception as e:
+                    logging.log(ERROR, "%r: %s in format", self, name(e))
+            self.dispatch(batch, formatted)
+
+    def expose(self):
+        """Rewrite the metrics file every INTERVAL seconds."""
+        logging.log(DEBUG, "%r: expose loop started", self)
+        while self.active:
+            time.sleep(self.interval)
+            self.write()
+
+    def tick(self):
+        """Turn the timer wheel every TICK seconds."""
+        logging.log(DEBUG, "%r: tick loop started", self)
+        while self.active:
+            time.sleep(self.wheel.tick)
+            self.wheel.advance()
+
+    def write(self):
+        """Write the metrics file, if there is one."""
+        try:
+            self.metrics.write(self.export)
+        except OSError as e:
+            logging.log(ERROR, "%r: %s in expose", self, name(e))
+
+    # Main
+    def bind(self) -> bool:
+        """Bind the listening socket, returning whether it succeeded."""
+        try:
+            self.socket = socket.socket()
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(self.address)
+            self.socket.listen(self.backlog)
+            logging.log(DEBUG, "%r: bound", self)
+        except OSError as e:
+            logging.log(FATAL, "%r: could not bind", self)
+            return False
+        return True
+
+    def activate(self):
+        """Activate the server. Accepts clients on a listen thread, with one
+        receive thread per handler, and runs the serve loop until ctrl-c."""
+        if self.active:
+            logging.log(WARNING, "%r: already actvated", self)
+            return
+        if not self.bind():
+            return
+        self.active = True
+        self.listen_thread = threading.Thread(target=self.listen)
+        self.listen_thread.start()
+        self.tick_thread = threading.Thread(target=self.tick, daemon=True)
+        self.tick_thread.start()
+        if self.formatter:
+            self.deliver_thread = threading.Thread(target=self.deliver)
+            self.deliver_thread.start()
+        if self.export:
+            self.expose_thread = threading.Thread(
+                target=self.expose, daemon=True)
+            self.expose_thread.start()
+        logging.log(logging.INFO, "%r: activated", self)
+        try:
+            logging.log(
+                logging.INFO, "%r: type ctrl-c to shut down", self)
+            self.serve()
+        except KeyboardInterrupt:
+            logging.log(
+                logging.INFO, "%r: received ctrl-c", self)
+            self.shutdown()
+
+    def shutdown(self):
+        """Shut down the server and all of its handlers."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        for handler in list(self.handlers):
+            handler.shutdown()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR) # Wakes up accept
+        except OSError:
+            pass
+        self.socket.close()
+        self.messages.wake()
+        self.pending.wake()
+        for handler, message, timer in self.sessions.values():
+            timer.cancel()
+        self.pool.shutdown(wait=False)
+        if self.formatter:
+            self.formatter.shutdown()
+        if self.history:
+            self.history.close()
+        if self.search:
+            self.search.close()
+        if self.export:
+            self.write()
+        logging.log(logging.INFO, "%r: shut down", self)
+
+class AsyncHandler(Handler):
+    """Handler that runs as a coroutine on the server's event loop instead of
+    on its own receive thread."""
+
+    # Magic
+    def __init__(self, reader, writer, server):
+        """Initialize a new handler based on an asyncio stream pair and chat
+        server."""
+        self.reader = reader
+        self.writer = writer
+        address = writer.get_extra_info("peername")
+        super().__init__(writer.get_extra_info("socket"), address, server)
+        self.outbox = asyncio.Queue(server.outbox)
+
+    # Function
+    def give(self, message):
+        """Give a message to the parent server."""
+        self.server.received.inc()
+        self.server.messages.put_nowait(message)
+
+    def write(self, data):
+        """Queue an already encoded message for the transmit loop, applying
+        the server's policy when the outbox is full."""
+        try:
+            self.outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            self.overflow(data)
+
+    async def read(self):
+        """Read the next complete frame from the connected client."""
+        header = await self.reader.readexactly(HEADER.size)
+        size, = HEADER.unpack(header)
+        if size > LIMIT:
+            raise ValueError("frame of %d bytes exceeds limit" % size)
+        body = await self.reader.readexactly(size)
+        start = time.perf_counter()
+        message = decode(body)
+        self.server.decoding.observe(time.perf_counter() - start)
+        return message
+
+    # Loop
+    async def receive(self):
+        """Receive messages from the connected client. Also handles connection
+        and disconnection from the server."""
+        logging.log(DEBUG, "%r: receive loop started", self)
+        try:
+            self.join(await asyncio.wait_for(
+                self.read(), self.server.handshake))
+        except Exception as e:
+            logging.log(WARNING, "%r: %s in handshake", self, name(e))
+            if self.active:
+                self.shutdown()
+            return
+        message = new(
+            time=time.time(), template=INFO, message=JOIN % self.info["name"],
+            event=JOINED, handler=self)
+        self.give(message)
+        logging.log(DEBUG, "%r: joined", self)
+        while self.active:
+            try:
+                message = await self.read()
+                wait = self.accept(message)
+                while wait: # The transport backs up onto the client
+                    await asyncio.sleep(wait)
+                    wait = self.accept(message, True)
+            except Exception as e:
+                if self.active:
+                    logging.log(
+                        ERROR, "%r: %s in receive", self, name(e))
+                    self.shutdown()
+        message = new(
+            time=time.time(), template=INFO, message=EXIT % self.info["name"],
+            event=EXITED, handler=self)
+        self.give(message)
+        logging.log(DEBUG, "%r: exited", self)
+        logging.log(DEBUG, "%r: receive loop finished", self)
+
+    async def transmit(self):
+        """Send queued messages to the connected client, every frame queued
+        within the FLUSH window in one write, then wait for the transport to
+        drain so the outbox is what fills up for slow clients."""
+        logging.log(DEBUG, "%r: transmit loop started", self)
+        while self.active:
+            batch = [await self.outbox.get()]
+            if self.server.flush:
+                await asyncio.sleep(self.server.flush)
+            while not self.outbox.empty():
+                batch.append(self.outbox.get_nowait())
             try:
-                while not self.messages.empty():
-                    message = self.messages.get()
-                    formatted = string(message["format"], message)
-                    message = new(message=formatted)
-                    self.send(message)
+                start = time.perf_counter()
+                self.writer.writelines(batch)
+                await self.writer.drain()
+                self.latency.observe(time.perf_counter() - start)
+                self.server.sent.inc(len(batch))
+                self.server.writes.inc()
             except Exception as e:
                 if self.active:
-                    logging.log(ERROR, "%s: %s in serve", repr(self), name(e))
+                    logging.log(
+                        ERROR, "%r: %s in transmit", self, name(e))
+                    self.shutdown()
+        logging.log(DEBUG, "%r: transmit loop finished", self)
 
+    # Main
     def activate(self):
         """Activate the handler."""
         if self.active:
-            logging.log(WARNING, "%s: already actvated", repr(self))
+            logging.log(WARNING, "%r: already activated", self)
+            return
+        self.active = True
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.receive_task = asyncio.ensure_future(self.receive())
+        self.transmit_task = asyncio.ensure_future(self.transmit())
+        self.server.handlers.add(self)
+        if self.server.idle:
+            self.server.wheel.add(self.server.idle, self.check)
+        logging.log(logging.INFO, "%r: activated", self)
+
+    def shutdown(self):
+        """Shut down the handler."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        self.server.handlers.discard(self)
+        self.transmit_task.cancel()
+        self.writer.close()
+        logging.log(logging.INFO, "%r: shut down", self)
+
+class AsyncServer(Server):
+    """Chat server that runs the listen and serve loops and every handler as
+    coroutines on a single asyncio event loop."""
+
+    # Magic
+    def __init__(self, address, **options):
+        """Initialize a new chat server on an address, taking the same
+        options as the threaded server."""
+        super().__init__(address, **options)
+        self.messages = asyncio.Queue()
+        self.pending = asyncio.Queue(self.pending.maxsize)
+
+    # Function
+    def defer(self, function, *args):
+        """Run a function on the server's pool, off the event loop, returning
+        a future whose callbacks run on the loop."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.pool, function, *args)
+
+    # Loop
+    async def listen(self, reader, writer):
+        """Accept an incoming connection from a possible client."""
+        try:
+            self.accepted.inc()
+            handler = AsyncHandler(reader, writer, self)
+            handler.activate()
+        except Exception as e:
+            if self.active:
+                logging.log(ERROR, "%r: %s in listen", self, name(e))
+
+    async def serve(self):
+        """Main server loop handles incoming messages and handles them. With a
+        format stage it only hands batches on, waiting once DEPTH of them
+        are waiting to be delivered."""
+        logging.log(DEBUG, "%r: serve loop started", self)
+        while self.active:
+            batch = await self.drain()
+            if self.formatter:
+                await self.pending.put((batch, self.prepare(batch)))
+            else:
+                self.dispatch(batch)
+
+    async def deliver(self):
+        """Handle batches from the serve loop in the order it took them, each
+        once the format stage is done with it."""
+        logging.log(DEBUG, "%r: deliver loop started", self)
+        while self.active:
+            batch, future = await self.pending.get()
+            formatted = None
+            if future:
+                try:
+                    formatted = dict(await asyncio.wrap_future(future))
+                except Exception as e:
+                    logging.log(ERROR, "%r: %s in format", self, name(e))
+            self.dispatch(batch, formatted)
+
+    async def expose(self):
+        """Rewrite the metrics file every INTERVAL seconds."""
+        logging.log(DEBUG, "%r: expose loop started", self)
+        while self.active:
+            await asyncio.sleep(self.interval)
+            self.write()
+
+    async def tick(self):
+        """Turn the timer wheel every TICK seconds."""
+        logging.log(DEBUG, "%r: tick loop started", self)
+        while self.active:
+            await asyncio.sleep(self.wheel.tick)
+            self.wheel.advance()
+
+    async def drain(self) -> list:
+        """Wait for a message, then remove and return up to BATCH messages.
+        A positive LINGER sleeps that long first when the batch is short."""
+        batch = [await self.messages.get()]
+        if self.linger and self.messages.qsize() < self.batch - 1:
+            await asyncio.sleep(self.linger)
+        while len(batch) < self.batch and not self.messages.empty():
+            batch.append(self.messages.get_nowait())
+        return batch
+
+    async def run(self):
+        """Bind the server and run it until it is shut down."""
+        try:
+            self.socket = await asyncio.start_server(
+                self.listen, *self.address, reuse_address=True,
+                backlog=self.backlog)
+            logging.log(DEBUG, "%r: bound", self)
+        except OSError as e:
+            logging.log(FATAL, "%r: could not bind", self)
+            return
+        self.active = True
+        self.serve_task = asyncio.ensure_future(self.serve())
+        self.tick_task = asyncio.ensure_future(self.tick())
+        if self.formatter:
+            self.deliver_task = asyncio.ensure_future(self.deliver())
+        if self.export:
+            self.expose_task = asyncio.ensure_future(self.expose())
+        logging.log(logging.INFO, "%r: activated", self)
+        try:
+            await self.serve_task
+        except asyncio.CancelledError: # Ctrl-c cancels the run
+            if self.active:
+                logging.log(
+                    logging.INFO, "%r: received ctrl-c", self)
+        finally:
+            if self.active:
+                self.shutdown()
+
+    # Main
+    def activate(self):
+        """Activate the server. Runs the event loop until ctrl-c."""
+        if self.active:
+            logging.log(WARNING, "%r: already actvated", self)
+            return
+        try:
+            logging.log(
+                logging.INFO, "%r: type ctrl-c to shut down", self)
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            logging.log(
+                logging.INFO, "%r: received ctrl-c", self)
+
+    def shutdown(self):
+        """Shut down the server and all of its handlers. Must be called from
+        the server's event loop."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        for handler in list(self.handlers):
+            handler.shutdown()
+        self.socket.close()
+        self.serve_task.cancel()
+        self.tick_task.cancel()
+        for handler, message, timer in self.sessions.values():
+            timer.cancel()
+        self.pool.shutdown(wait=False)
+        if self.formatter:
+            self.deliver_task.cancel()
+            self.formatter.shutdown()
+        if self.history:
+            self.history.close()
+        if self.search:
+            self.search.close()
+        if self.export:
+            self.expose_task.cancel()
+            self.write()
+        logging.log(logging.INFO, "%r: shut down", self)
+
+class Worker(Server):
+    """Chat server running in one process of a cluster. Shares its port with
+    the other workers and relays broadcasts to them over the cluster bus."""
+
+    # Magic
+    def __init__(self, address, path, index, **options):
+        """Initialize a new worker on a shared address, relaying through the
+        bus listening at a Unix-domain socket path. Each worker keeps its own
+        copy of the history and metrics, suffixed with its index."""
+        self.path = path
+        self.index = index
+        if options.get("history", HISTORY):
+            options["history"] = "%s.%d" % (
+                options.get("history", HISTORY), index)
+        if options.get("metrics"):
+            options["metrics"] = "%s.%d" % (options["metrics"], index)
+        options["window"] = None # Sequence numbers would differ per worker
+        if options.get("pool") == PROCESS: # Daemonic processes cannot fork
+            options["pool"] = THREAD
+        super().__init__(address, **options)
+
+    def __repr__(self):
+        """Return repr(worker)."""
+        return "Worker<%s:%d>" % (self.address[0], self.index)
+
+    # Function
+    def broadcast(self, data, room=None, text=None):
+        """Write an already encoded message to every local handler in a room
+        and publish it to the other workers."""
+        super().broadcast(data, room, text)
+        try:
+            self.bus.sendall(data)
+        except OSError as e:
+            if self.active:
+                logging.log(ERROR, "%r: %s in publish", self, name(e))
+
+    # Loop
+    def relay(self):
+        """Deliver broadcasts published by other workers to local handlers."""
+        logging.log(DEBUG, "%r: relay loop started", self)
+        stream = Stream()
+        while True: # Started from bind, before the server is active
+            try:
+                data = stream.read(self.bus, raw=True)
+                room = decode(data[HEADER.size:]).get("room")
+                Server.broadcast(self, data, room)
+            except Exception as e:
+                if self.active:
+                    logging.log(ERROR, "%r: %s in relay", self, name(e))
+                    self.shutdown()
+                break
+
+    # Main
+    def bind(self) -> bool:
+        """Bind the shared listening socket and connect to the bus."""
         try:
             self.socket = socket.socket()
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.socket.bind(self.address)
-            self.socket.listen(5)
-            logging.log(DEBUG, "%s: bound" % repr(self))
+            self.socket.listen(self.backlog)
+            self.bus = socket.socket(socket.AF_UNIX)
+            self.bus.connect(self.path)
+            logging.log(DEBUG, "%r: bound", self)
         except OSError as e:
-            logging.log(FATAL, "%s: could not bind" % repr(self))
+            logging.log(FATAL, "%r: could not bind", self)
+            return False
+        self.relay_thread = threading.Thread(target=self.relay, daemon=True)
+        self.relay_thread.start()
+        return True
+
+def work(address, path, index, options):
+    """Run a cluster worker. Target of each worker process."""
+    if LISTENER: # Threads do not survive the fork
+        LISTENER.start()
+    worker = Worker(address, path, index, **options)
+    worker.activate()
+
+class Bus:
+    """Relay between the workers of a cluster over a Unix-domain socket. Each
+    frame published by a worker is forwarded to every other worker."""
+
+    # Magic
+    def __init__(self, path):
+        """Initialize a new bus listening on a Unix-domain socket path."""
+        self.path = path
+        self.links = list()
+        self.lock = threading.Lock()
+        self.active = False
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(bus)."""
+        return "Bus<%s>" % self.path
+
+    # Loop
+    def listen(self):
+        """Accept connections from workers."""
+        logging.log(DEBUG, "%r: listen loop started", self)
+        while self.active:
+            try:
+                link, address = self.socket.accept()
+                with self.lock:
+                    self.links.append(link)
+                threading.Thread(
+                    target=self.forward, args=(link,), daemon=True).start()
+            except Exception as e:
+                if self.active:
+                    logging.log(ERROR, "%r: %s in listen", self, name(e))
+
+    def forward(self, link):
+        """Forward frames published by one worker to all the others."""
+        stream = Stream()
+        while self.active:
+            try:
+                data = stream.read(link, raw=True)
+            except Exception as e:
+                if self.active:
+                    logging.log(
+                        ERROR, "%r: %s in forward", self, name(e))
+                break
+            with self.lock:
+                for other in self.links:
+                    if other is not link:
+                        other.sendall(data)
+        with self.lock:
+            self.links.remove(link)
+
+    # Main
+    def activate(self):
+        """Activate the bus."""
+        if self.active:
+            logging.log(WARNING, "%r: already activated", self)
             return
-        logging.log(DEBUG, "%s: initialized" % repr(self))
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.bind(self.path)
+        self.socket.listen(WORKERS)
+        self.active = True
+        self.listen_thread = threading.Thread(target=self.listen, daemon=True)
+        self.listen_thread.start()
+        logging.log(logging.INFO, "%r: activated", self)
+
+    def shutdown(self):
+        """Shut down the bus."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        self.socket.close()
+        with self.lock:
+            for link in self.links:
+                link.close()
+        os.unlink(self.path)
+        logging.log(logging.INFO, "%r: shut down", self)
+
+class Cluster:
+    """Runs several worker processes on one port via SO_REUSEPORT, so a chat
+    server can use more than one core. Broadcasts cross between workers on a
+    local bus, so every client sees every message."""
+
+    # Magic
+    def __init__(self, address, workers=WORKERS, **options):
+        """Initialize a new cluster of WORKERS processes on an address. Other
+        OPTIONS are passed on to each worker, with the server-wide TOTAL
+        rate split between them."""
+        self.address = address
+        self.workers = workers
+        if options.get("total"):
+            options["total"] = options["total"] / workers
+        self.options = options
+        self.processes = list()
+        self.active = False
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(cluster)."""
+        return "Cluster<%s>" % self.address[0]
+
+    # Main
+    def activate(self):
+        """Activate the cluster, blocking until ctrl-c."""
+        if self.active:
+            logging.log(WARNING, "%r: already activated", self)
+            return
+        self.active = True
+        self.directory = tempfile.mkdtemp(prefix="pychat-")
+        self.bus = Bus(os.path.join(self.directory, "bus"))
+        self.bus.activate()
+        for index in range(self.workers):
+            process = multiprocessing.Process(
+                target=work, daemon=True,
+                args=(self.address, self.bus.path, index, self.options))
+            process.start()
+            self.processes.append(process)
+        logging.log(logging.INFO, "%r: activated", self)
+        try:
+            logging.log(
+                logging.INFO, "%r: type ctrl-c to shut down", self)
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            logging.log(
+                logging.INFO, "%r: received ctrl-c", self)
+            self.shutdown()
+
+    def shutdown(self):
+        """Shut down the cluster and all of its workers."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.bus.shutdown()
+        os.rmdir(self.directory)
+        logging.log(logging.INFO, "%r: shut down", self)
+
+MODES = {THREAD: Server, ASYNC: AsyncServer, CLUSTER: Cluster}
+
+def server(address=ADDRESS, mode=THREAD, **options):
+    """Convenience function for running a chat server. MODE selects between
+    one thread per handler, a single asyncio event loop, or a cluster of
+    worker processes, and OPTIONS are passed on to the server, such as batch
+    and linger."""
+    server = MODES[mode](address, **options)
+    server.activate()
+    return server
+
+# Client
+class Client:
+    """Headless chat client. Messages from the server are passed to a
+    callback, or queued for iteration, and outgoing messages are pipelined:
+    send never waits, and the transmit loop writes everything queued since
+    its last write in one call."""
+
+    # Magic
+    def __init__(self, address, name, callback=None, batch=BATCH):
+        """Initialize a new, named client for a server address. Received
+        messages are passed to CALLBACK on the receive thread if given, and
+        otherwise queued for iterating over the client. Up to BATCH queued
+        messages are written at once."""
+        self.address = address
+        self.name = name
+        self.callback = callback
+        self.batch = batch
+        self.token = None
+        self.run = None
+        self.sequence = 0
+        self.outbox = Queue()
+        self.messages = Queue()
+        self.active = False
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(client)."""
+        return "Client<%s>" % self.name
+
+    def __iter__(self):
+        """Yield received messages until the client shuts down."""
+        while True:
+            message = self.messages.get()
+            if message is None: # Wakeup from shutdown
+                return
+            yield message
+
+    # Function
+    def send(self, text):
+        """Send a chat message, or a command such as "/join lounge"."""
+        self.write(encode(new(time=time.time(), name=self.name, message=text)))
+
+    def write(self, data):
+        """Queue an already encoded message for the transmit loop."""
+        self.outbox.put(data)
+
+    # Loop
+    def receive(self):
+        """Receive messages from the server."""
+        logging.log(DEBUG, "%r: receive loop started", self)
+        while self.active:
+            try:
+                message = self.stream.read(self.socket)
+            except Exception as e:
+                if self.active:
+                    logging.log(
+                        ERROR, "%r: %s in receive", self, name(e))
+                    self.shutdown()
+                break
+            if message.get("event") == PING:
+                self.write(ANSWER)
+                continue
+            if message.get("event") == ADMITTED:
+                self.name, self.token = message["name"], message["token"]
+                continue
+            if "seq" in message:
+                self.run, self.sequence = message.get("run"), message["seq"]
+            if self.callback:
+                self.callback(message)
+            else:
+                self.messages.put(message)
+        self.messages.wake()
+        logging.log(DEBUG, "%r: receive loop finished", self)
+
+    def transmit(self):
+        """Write queued messages to the server, as many at once as are
+        waiting, until a wakeup from shutdown."""
+        logging.log(DEBUG, "%r: transmit loop started", self)
+        while True:
+            batch = self.outbox.batch(self.batch)
+            try:
+                writev(self.socket, [data for data in batch if data])
+            except Exception as e:
+                if self.active:
+                    logging.log(
+                        ERROR, "%r: %s in transmit", self, name(e))
+                    self.shutdown()
+                break
+            if None in batch:
+                break
+        logging.log(DEBUG, "%r: transmit loop finished", self)
+
+    # Main
+    def activate(self) -> bool:
+        """Connect and join, returning whether it succeeded. Receives and
+        transmits on background threads. Activating again after a shutdown
+        resumes the session from the last message received."""
+        if self.active:
+            logging.log(WARNING, "%r: already activated", self)
+            return True
+        try:
+            self.socket = socket.create_connection(self.address)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.socket.sendall(encode(new(
+                name=self.name, token=self.token, run=self.run,
+                seq=self.sequence)))
+            self.stream = Stream()
+        except OSError as e:
+            logging.log(ERROR, "%r: could not connect", self)
+            return False
+        self.active = True
+        self.receive_thread = threading.Thread(
+            target=self.receive, daemon=True)
+        self.receive_thread.start()
+        self.transmit_thread = threading.Thread(
+            target=self.transmit, daemon=True)
+        self.transmit_thread.start()
+        logging.log(logging.INFO, "%r: activated", self)
+        return True
+
+    def shutdown(self):
+        """Shut down the client once everything already sent is written."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.active = False
+        self.outbox.wake()
+        if threading.current_thread() is not self.transmit_thread:
+            self.transmit_thread.join()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        logging.log(logging.INFO, "%r: shut down", self)
+
+class AsyncClient:
+    """Headless chat client for asyncio, so one process can hold many
+    connections. Sends are pipelined: everything sent during one pass of the
+    event loop goes out in a single write."""
+
+    # Magic
+    def __init__(self, address, name, callback=None):
+        """Initialize a new, named client for a server address. Received
+        messages are passed to CALLBACK if given, and otherwise queued for
+        iterating over the client with async for."""
+        self.address = address
+        self.name = name
+        self.callback = callback
+        self.token = None
+        self.run = None
+        self.sequence = 0
+        self.pending = list()
+        self.messages = asyncio.Queue()
+        self.active = False
+        logging.log(DEBUG, "%r: initialized", self)
+
+    def __repr__(self):
+        """Return repr(client)."""
+        return "AsyncClient<%s>" % self.name
+
+    async def __aiter__(self):
+        """Yield received messages until the client shuts down."""
+        while True:
+            message = await self.messages.get()
+            if message is None: # Wakeup from shutdown
+                return
+            yield message
+
+    # Function
+    def send(self, text):
+        """Send a chat message, or a command such as "/join lounge"."""
+        self.write(encode(new(time=time.time(), name=self.name, message=text)))
+
+    def write(self, data):
+        """Queue an already encoded message, to be written along with the
+        rest of this pass of the event loop."""
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.pending.append(data)
+
+    def flush(self):
+        """Write every pending message at once."""
+        if self.active and self.pending:
+            self.writer.write(b"".join(self.pending))
+        self.pending.clear()
+
+    async def drain(self):
+        """Wait until the transport's buffer is below its high-water mark,
+        for senders that should slow down with the connection."""
+        self.flush()
+        await self.writer.drain()
+
+    # Loop
+    async def receive(self):
+        """Receive messages from the server."""
+        logging.log(DEBUG, "%r: receive loop started", self)
+        try:
+            while self.active:
+                data = await self.reader.read(SIZE * 64)
+                if not data:
+                    raise EOFError("connection closed")
+                self.stream.feed(data)
+                message = self.stream.next()
+                while message is not None:
+                    if message.get("event") == PING:
+                        self.write(ANSWER)
+                    elif message.get("event") == ADMITTED:
+                        self.name = message["name"]
+                        self.token = message["token"]
+                    else:
+                        if "seq" in message:
+                            self.run = message.get("run")
+                            self.sequence = message["seq"]
+                        if self.callback:
+                            self.callback(message)
+                        else:
+                            self.messages.put_nowait(message)
+                    message = self.stream.next()
+        except Exception as e:
+            if self.active:
+                logging.log(ERROR, "%r: %s in receive", self, name(e))
+                self.shutdown()
+        self.messages.put_nowait(None)
+        logging.log(DEBUG, "%r: receive loop finished", self)
+
+    # Main
+    async def activate(self) -> bool:
+        """Connect and join, returning whether it succeeded. Receives on a
+        task. Activating again after a shutdown resumes the session from the
+        last message received."""
+        if self.active:
+            logging.log(WARNING, "%r: already activated", self)
+            return True
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                *self.address)
+        except OSError as e:
+            logging.log(ERROR, "%r: could not connect", self)
+            return False
+        self.active = True
+        self.stream = Stream()
+        self.write(encode(new(
+            name=self.name, token=self.token, run=self.run,
+            seq=self.sequence)))
+        self.receive_task = asyncio.ensure_future(self.receive())
+        logging.log(logging.INFO, "%r: activated", self)
+        return True
+
+    def shutdown(self):
+        """Shut down the client once everything already sent is written."""
+        if not self.active:
+            logging.log(WARNING, "%r: already shut down", self)
+            return
+        self.flush()
+        self.active = False
+        self.writer.close()
+        logging.log(logging.INFO, "%r: shut down", self)